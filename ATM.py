@@ -1,83 +1,624 @@
+from threading import Lock, Condition, Thread, Event
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from array import array
+import hashlib
+import hmac
+import os
+import struct
+import zlib
+import math
+import numbers
+import json
+import time
+import asyncio
+import random
+import itertools
+from concurrent.futures import ProcessPoolExecutor
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
 # Card
 class Card:
-    def __init__(self, cardNo, PIN, accountId):
+    PIN_HASH_ITERATIONS = 100000
+
+    def __init__(self, cardNo, PIN, accountId, iterations=None):
         self.cardNo = cardNo
-        self.PIN = PIN
+        self.salt = os.urandom(16)
+        self.iterations = iterations or Card.PIN_HASH_ITERATIONS
+        self.PINHash = Card.hashPIN(PIN, self.salt, self.iterations)
         self.accountId = accountId
+        self.lock = Lock()    # serialises PIN checks on this card
 
-    def cardNo(self):
+    @staticmethod
+    def hashPIN(PIN, salt, iterations):
+        return hashlib.pbkdf2_hmac("sha256", str(PIN).encode(), salt, iterations)
+
+    def getCardNo(self):
         return self.cardNo
-    
-    def getPIN(self):
-        return self.PIN
+
+    def getAccountId(self):
+        return self.accountId
+
+    def getSalt(self):
+        return self.salt
+
+    def verifyPIN(self, PIN):
+        return hmac.compare_digest(self.PINHash, Card.hashPIN(PIN, self.salt, self.iterations))
+
+# Auth Cache
+class AuthCache:
+    def __init__(self, capacity=100000):
+        self.capacity = capacity
+        self.entries = OrderedDict()    # cardNo -> digest of the last verified PIN
+        self.lock = Lock()
+
+    def get(self, cardNo):
+        with self.lock:
+            if cardNo not in self.entries:
+                return None
+            self.entries.move_to_end(cardNo)
+            return self.entries[cardNo]
+
+    def put(self, cardNo, digest):
+        with self.lock:
+            self.entries[cardNo] = digest
+            self.entries.move_to_end(cardNo)
+            if len(self.entries) > self.capacity:
+                self.entries.popitem(last=False)
+
+    def invalidate(self, cardNo):
+        with self.lock:
+            self.entries.pop(cardNo, None)
 
 # Account
+# lightweight handle; balances live in an AccountStore
 class Account:
-    def __init__(self, accountId, balance):
+    def __init__(self, accountId, balance=0, store=None):
         self.accountId = accountId
-        self.balance = balance
-        self.lock = Lock()
+        self.store = store
+        if self.store is None:
+            self.store = AccountStore(1)
+            self.store.addAccount(accountId, balance)
 
     def getAccountId(self):
         return self.accountId
     
     def getBalance(self):
-        return self.balance
+        return self.store.getBalance(self.accountId)
 
     def deposit(self, amount):
-        with self.lock:
-            self.balance += amount
+        self.store.deposit(self.accountId, amount)
 
     def withdraw(self, amount):
-        with self.lock:
-            if self.balance < amount:
+        return self.store.withdraw(self.accountId, amount)
+
+# Account Store
+class AccountShard:
+    def __init__(self):
+        self.slots = {}    # accountId -> index into balances
+        self.balances = array('q')    # balances in the smallest currency unit
+        self.lock = Lock()
+
+class AccountStore:
+    def __init__(self, numShards=64):
+        self.shards = [AccountShard() for _ in range(numShards)]
+        self.journal = None    # TransactionJournal, set once replay has finished
+
+    def shardIndex(self, accountId):
+        return hash(accountId) % len(self.shards)
+
+    @staticmethod
+    def toUnits(amount, positive=False):
+        # balances are whole currency units: 10 and 10.0 are accepted, 10.5 is rejected;
+        # movements (positive=True) must also be above zero
+        if isinstance(amount, float) and amount.is_integer():
+            amount = int(amount)
+        elif isinstance(amount, numbers.Integral) and not isinstance(amount, bool):
+            amount = int(amount)
+        else:
+            raise ValueError(f"amount must be a whole number of currency units, got {amount!r}")
+        if positive and amount <= 0:
+            raise ValueError(f"amount must be positive, got {amount!r}")
+        return amount
+
+    def log(self, op, amount, accountId, dstId=None):
+        # caller must hold the shard lock(s), so journal order matches apply order per account
+        if self.journal is None:
+            return None
+        return self.journal.append(op, amount, accountId, dstId)
+
+    def sync(self, seq):
+        if seq is not None:
+            self.journal.waitDurable(seq)
+
+    def addAccount(self, accountId, balance):
+        balance = self.toUnits(balance)
+        shard = self.shards[self.shardIndex(accountId)]
+        with shard.lock:
+            if accountId in shard.slots:
+                shard.balances[shard.slots[accountId]] = balance
+            else:
+                shard.slots[accountId] = len(shard.balances)
+                shard.balances.append(balance)
+            seq = self.log(JournalOp.OPEN, balance, accountId)
+        self.sync(seq)
+
+    def hasAccount(self, accountId):
+        return accountId in self.shards[self.shardIndex(accountId)].slots
+
+    def getAccount(self, accountId):
+        if not self.hasAccount(accountId):
+            return None
+        return Account(accountId, store=self)
+
+    def getBalance(self, accountId):
+        shard = self.shards[self.shardIndex(accountId)]
+        with shard.lock:
+            return shard.balances[shard.slots[accountId]]
+
+    def deposit(self, accountId, amount):
+        amount = self.toUnits(amount, positive=True)
+        shard = self.shards[self.shardIndex(accountId)]
+        with shard.lock:
+            shard.balances[shard.slots[accountId]] += amount
+            seq = self.log(JournalOp.DEPOSIT, amount, accountId)
+        self.sync(seq)
+
+    def withdraw(self, accountId, amount):
+        amount = self.toUnits(amount, positive=True)
+        shard = self.shards[self.shardIndex(accountId)]
+        with shard.lock:
+            slot = shard.slots[accountId]
+            if shard.balances[slot] < amount:
                 return False
-            self.balance -= amount
-            return True
+            shard.balances[slot] -= amount
+            seq = self.log(JournalOp.WITHDRAW, amount, accountId)
+        self.sync(seq)
+        return True
+
+    def transfer(self, src, dst, amount):
+        # shard locks are always taken in index order, so concurrent transfers cannot deadlock
+        amount = self.toUnits(amount, positive=True)
+        srcIndex, dstIndex = self.shardIndex(src), self.shardIndex(dst)
+        srcShard, dstShard = self.shards[srcIndex], self.shards[dstIndex]
+        if dst not in dstShard.slots:
+            return False
+        first, second = min(srcIndex, dstIndex), max(srcIndex, dstIndex)
+        with self.shards[first].lock:
+            if second != first:
+                self.shards[second].lock.acquire()
+            try:
+                srcSlot = srcShard.slots.get(src)
+                if srcSlot is None or srcShard.balances[srcSlot] < amount:
+                    return False
+                srcShard.balances[srcSlot] -= amount
+                dstShard.balances[dstShard.slots[dst]] += amount
+                seq = self.log(JournalOp.TRANSFER, amount, src, dst)
+            finally:
+                if second != first:
+                    self.shards[second].lock.release()
+        self.sync(seq)
+        return True
+
+    def apply(self, op, amount, accountId, dstId):
+        # replays a journal record without journaling it again
+        if op == JournalOp.OPEN:
+            self.addAccount(accountId, amount)
+        elif op == JournalOp.DEPOSIT:
+            self.deposit(accountId, amount)
+        elif op == JournalOp.WITHDRAW:
+            self.withdraw(accountId, amount)
+        elif op == JournalOp.TRANSFER:
+            self.transfer(accountId, dstId, amount)
+
+    def lockAll(self):
+        for shard in self.shards:
+            shard.lock.acquire()
+
+    def unlockAll(self):
+        for shard in reversed(self.shards):
+            shard.lock.release()
+
+    def items(self):
+        # caller must hold every shard lock
+        for shard in self.shards:
+            for accountId, slot in shard.slots.items():
+                yield accountId, shard.balances[slot]
+
+    def listAccountIds(self):
+        res = []
+        for shard in self.shards:
+            with shard.lock:
+                res.extend(shard.slots)
+        return res
         
+# Transaction Journal
+class JournalOp:
+    OPEN = 1
+    DEPOSIT = 2
+    WITHDRAW = 3
+    TRANSFER = 4
+
+class TransactionJournal:
+    # frame: <length, crc32> + <seq, op, amount> + accountId + dstId
+    FRAME_HEADER = struct.Struct('<II')
+    RECORD_HEADER = struct.Struct('<QBq')
+    SNAPSHOT_INTERVAL = 100000    # records between automatic snapshots
+
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        self.journalPath = os.path.join(directory, "journal.log")
+        self.snapshotPath = os.path.join(directory, "snapshot.bin")
+        self.file = None
+        self.pending = []    # encoded frames not yet written
+        self.nextSeq = 1
+        self.durableSeq = 0
+        self.snapshotSeq = 0
+        self.flushing = False
+        self.error = None    # first failed flush; sticky, since later frames would sit behind a torn one
+        self.cond = Condition()
+        self.stopped = Event()
+        self.snapshotThread = None
+
+    @staticmethod
+    def encodeId(accountId):
+        if accountId is None:
+            return b'n'
+        if isinstance(accountId, int):
+            return b'i' + struct.pack('<q', accountId)
+        data = str(accountId).encode()
+        return b's' + struct.pack('<H', len(data)) + data
+
+    @staticmethod
+    def decodeId(data, offset):
+        tag = data[offset:offset + 1]
+        if tag == b'n':
+            return None, offset + 1
+        if tag == b'i':
+            return struct.unpack_from('<q', data, offset + 1)[0], offset + 9
+        length = struct.unpack_from('<H', data, offset + 1)[0]
+        return data[offset + 3:offset + 3 + length].decode(), offset + 3 + length
+
+    def encode(self, seq, op, amount, accountId, dstId):
+        body = self.RECORD_HEADER.pack(seq, op, amount) + self.encodeId(accountId) + self.encodeId(dstId)
+        return self.FRAME_HEADER.pack(len(body), zlib.crc32(body)) + body
+
+    def decode(self, body):
+        seq, op, amount = self.RECORD_HEADER.unpack_from(body)
+        accountId, offset = self.decodeId(body, self.RECORD_HEADER.size)
+        dstId, _ = self.decodeId(body, offset)
+        return seq, op, amount, accountId, dstId
+
+    def readFrames(self, path):
+        # yields (endOffset, record); stops at the first torn or corrupt frame
+        if not os.path.exists(path):
+            return
+        with open(path, "rb") as f:
+            data = f.read()
+        offset = 0
+        while offset + self.FRAME_HEADER.size <= len(data):
+            length, crc = self.FRAME_HEADER.unpack_from(data, offset)
+            start = offset + self.FRAME_HEADER.size
+            body = data[start:start + length]
+            if len(body) < length or zlib.crc32(body) != crc:
+                return
+            offset = start + length
+            yield offset, self.decode(body)
+
+    def replay(self, store):
+        # rebuilds store from the last snapshot plus the journal tail, then opens the journal for appends
+        for _, (seq, op, amount, accountId, dstId) in self.readFrames(self.snapshotPath):
+            self.snapshotSeq = seq
+            if accountId is not None:
+                store.apply(op, amount, accountId, dstId)
+        lastSeq, validLength = self.snapshotSeq, 0
+        for offset, (seq, op, amount, accountId, dstId) in self.readFrames(self.journalPath):
+            validLength = offset
+            if seq > self.snapshotSeq:
+                store.apply(op, amount, accountId, dstId)
+                lastSeq = seq
+        self.file = open(self.journalPath, "ab")
+        self.file.truncate(validLength)
+        self.nextSeq = lastSeq + 1
+        self.durableSeq = lastSeq
+
+    def append(self, op, amount, accountId, dstId=None):
+        with self.cond:
+            seq = self.nextSeq
+            self.nextSeq += 1
+            self.pending.append(self.encode(seq, op, amount, accountId, dstId))
+            return seq
+
+    def waitDurable(self, seq):
+        # group commit: the first waiter flushes every pending frame with one fsync, the rest wait for it;
+        # if the flush fails, every waiter not yet durable raises
+        with self.cond:
+            while self.durableSeq < seq:
+                if self.error is not None:
+                    raise OSError(f"journal flush failed, record {seq} is not durable") from self.error
+                if self.flushing:
+                    self.cond.wait()
+                    continue
+                self.flushing = True
+                batch, self.pending = self.pending, []
+                upto = self.nextSeq - 1
+                self.cond.release()
+                error = None
+                try:
+                    self.file.write(b''.join(batch))
+                    self.file.flush()
+                    os.fsync(self.file.fileno())
+                except BaseException as e:
+                    error = e
+                self.cond.acquire()
+                self.flushing = False
+                if error is None:
+                    self.durableSeq = upto
+                else:
+                    self.error = error
+                self.cond.notify_all()
+
+    def snapshot(self, store):
+        # writes every balance with the current sequence number, then truncates the journal
+        store.lockAll()
+        try:
+            seq = self.nextSeq - 1
+            self.waitDurable(seq)
+            tmpPath = self.snapshotPath + ".tmp"
+            with open(tmpPath, "wb") as f:
+                for accountId, balance in store.items():
+                    f.write(self.encode(seq, JournalOp.OPEN, balance, accountId, None))
+                # marker record, so an empty store still carries the snapshot sequence
+                f.write(self.encode(seq, JournalOp.OPEN, 0, None, None))
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmpPath, self.snapshotPath)
+            self.file.truncate(0)
+            self.snapshotSeq = seq
+        finally:
+            store.unlockAll()
+
+    def runSnapshots(self, store, interval):
+        while not self.stopped.wait(interval):
+            if self.nextSeq - 1 - self.snapshotSeq >= self.SNAPSHOT_INTERVAL:
+                self.snapshot(store)
+
+    def startSnapshots(self, store, interval=60.0):
+        if self.snapshotThread is None:
+            self.snapshotThread = Thread(target=self.runSnapshots, args=(store, interval), daemon=True)
+            self.snapshotThread.start()
+
+    def close(self):
+        self.stopped.set()
+        if self.snapshotThread is not None:
+            self.snapshotThread.join()
+            self.snapshotThread = None
+        self.waitDurable(self.nextSeq - 1)
+        self.file.close()
+
 # Bank Server
 class BankServer:
-    def __init__(self):
-        self.accounts = {}    # accountId -> Account
+    MAX_PIN_ATTEMPTS = 3
+
+    def __init__(self, numShards=64, journalDir=None):
+        self.accounts = AccountStore(numShards)
         self.cards = {}    # cardNo -> Card
+        self.authCache = AuthCache()
+        self.authKey = os.urandom(32)    # keys the cached digests; never leaves this process
+        self.failedAttempts = {}    # cardNo -> consecutive failed PIN attempts
+        self.lock = Lock()
+        self.journal = None
+        if journalDir is not None:
+            self.journal = TransactionJournal(journalDir)
+            self.journal.replay(self.accounts)
+            self.accounts.journal = self.journal
+            self.journal.startSnapshots(self.accounts)
+
+    def close(self):
+        if self.journal is not None:
+            self.journal.close()
 
     def addAccount(self, account):
-        self.accounts[account.getAccountId()] = account
+        self.accounts.addAccount(account.getAccountId(), account.getBalance())
+        account.store = self.accounts
+
+    def getAccountById(self, accountId):
+        return self.accounts.getAccount(accountId)
+
+    def deposit(self, accountId, amount):
+        self.accounts.deposit(accountId, amount)
+
+    def withdraw(self, accountId, amount):
+        return self.accounts.withdraw(accountId, amount)
+
+    def transfer(self, src, dst, amount):
+        return self.accounts.transfer(src, dst, amount)
 
     def addCard(self, card):
         self.cards[card.getCardNo()] = card
 
-    def validatePIN(self, currCardNo, PIN):
-        for cardNo, card in self.cards.items():
-            if cardNo == currCardNo:
-                if card.getPIN() == PIN:
-                    return True
-            else:
+    def validatePIN(self, cardNo, PIN):
+        card = self.cards.get(cardNo)
+        if card is None:
+            return False
+        # checks on one card run one at a time, so parallel guesses cannot get past MAX_PIN_ATTEMPTS;
+        # correct logins queued behind a slow verify then hit the cache
+        with card.lock:
+            if self.isLocked(cardNo):
                 return False
-        return False
+            # the cache stores a digest keyed with a server secret, so repeat logins skip the slow PIN hash
+            # and a copy of the cache cannot be brute-forced over the 4-digit PIN space
+            digest = hmac.new(self.authKey, card.getSalt() + str(PIN).encode(), hashlib.sha256).digest()
+            cached = self.authCache.get(cardNo)
+            if cached is not None and hmac.compare_digest(cached, digest):
+                self.resetFailedAttempts(cardNo)
+                return True
+            if card.verifyPIN(PIN):
+                self.authCache.put(cardNo, digest)
+                self.resetFailedAttempts(cardNo)
+                return True
+            with self.lock:
+                self.failedAttempts[cardNo] = self.failedAttempts.get(cardNo, 0) + 1
+            self.authCache.invalidate(cardNo)
+            return False
+
+    def isLocked(self, cardNo):
+        return self.failedAttempts.get(cardNo, 0) >= self.MAX_PIN_ATTEMPTS
+
+    def resetFailedAttempts(self, cardNo):
+        if cardNo in self.failedAttempts:
+            with self.lock:
+                self.failedAttempts.pop(cardNo, None)
+
+    def unlockCard(self, cardNo):
+        self.resetFailedAttempts(cardNo)
+        self.authCache.invalidate(cardNo)
     
     def getAccount(self, currCardNo):
         if currCardNo not in self.cards:
             return None
         card = self.cards[currCardNo]
-        return self.accounts[card.getAccountId()]
+        return self.accounts.getAccount(card.getAccountId())
     
 # Cash Dispenser
+class DispenseStrategy:
+    MIN_NOTES = 1
+    BALANCED = 2    # prefer notes from fuller cassettes to even out wear
+
+class BreakdownTable:
+    def __init__(self, denominations, counts, weights, maxAmount):
+        # bounded coin change as a 0/1 knapsack over binary-split bundles of notes
+        # (1, 2, 4, ... notes of a denomination); chosen[j][a] marks bundle j in the
+        # cheapest breakdown of a * unit using the first j + 1 bundles
+        self.unit = math.gcd(*denominations)
+        size = maxAmount // self.unit + 1
+        self.bundles = []    # (denomination, notes, weight)
+        for denomination, count, weight in zip(denominations, counts, weights):
+            k = 1
+            while count > 0:
+                take = min(k, count)
+                self.bundles.append((denomination, take, weight))
+                count -= take
+                k *= 2
+        cost = [0.0] + [math.inf] * (size - 1)
+        self.chosen = []
+        for denomination, notes, weight in self.bundles:
+            step = denomination * notes // self.unit
+            bundleCost = notes * weight
+            chosen = bytearray(size)
+            for a in range(size - 1, step - 1, -1):
+                candidate = cost[a - step] + bundleCost
+                if candidate < cost[a]:
+                    cost[a] = candidate
+                    chosen[a] = 1
+            self.chosen.append(chosen)
+        self.cost = cost
+
+    def breakdown(self, amount):
+        if amount <= 0 or amount % self.unit:
+            return None
+        a = amount // self.unit
+        if a >= len(self.cost) or self.cost[a] == math.inf:
+            return None
+        res = {}
+        for j in range(len(self.bundles) - 1, -1, -1):
+            if self.chosen[j][a]:
+                denomination, notes, _ = self.bundles[j]
+                res[denomination] = res.get(denomination, 0) + notes
+                a -= denomination * notes // self.unit
+        return res
+
 class CashDispenser:
-    def __init__(self, initialCash):
-        self.cash = initialCash
+    MAX_WITHDRAWAL = 20000
+    MAX_NOTES = 40    # notes the presenter can hand out in one withdrawal
+
+    def __init__(self, cassettes, strategy=DispenseStrategy.MIN_NOTES, capacity=2000):
+        self.cassettes = dict(cassettes)    # denomination -> note count
+        self.strategy = strategy
+        self.capacity = capacity    # notes per cassette, used to weigh wear
+        self.depositBin = 0    # cash taken in that is not recycled into the cassettes
+        self.dispensed = 0
+        self.accepted = 0
+        self.table = None
+        self.tableKey = None
         self.lock = Lock()
 
+    def getCash(self):
+        with self.lock:
+            return sum(denomination * count for denomination, count in self.cassettes.items())
+
+    def getCassettes(self):
+        with self.lock:
+            return dict(self.cassettes)
+
+    def getCounters(self):
+        # (cash dispensed, cash accepted) since start-up, for reconciliation against the ledger
+        with self.lock:
+            return self.dispensed, self.accepted
+
+    def tableFor(self):
+        # caller must hold self.lock; counts are capped at what one withdrawal could use, so the
+        # table is only rebuilt when a cassette change can actually alter a breakdown
+        denominations = sorted(d for d, count in self.cassettes.items() if count > 0)
+        if not denominations:
+            return None
+        counts = tuple(min(self.cassettes[d], self.MAX_NOTES, self.MAX_WITHDRAWAL // d) for d in denominations)
+        if self.strategy == DispenseStrategy.BALANCED:
+            # notes from emptier cassettes cost more; fullness is bucketed into quarters so the
+            # weights, and with them the table, only change occasionally
+            weights = tuple(5 - min(self.cassettes[d], self.capacity) * 4 // self.capacity for d in denominations)
+        else:
+            weights = (1,) * len(denominations)
+        key = (tuple(denominations), counts, weights)
+        if key != self.tableKey:
+            self.table = BreakdownTable(denominations, counts, weights, self.MAX_WITHDRAWAL)
+            self.tableKey = key
+        return self.table
+
+    def breakdown(self, amount):
+        # caller must hold self.lock
+        table = self.tableFor()
+        notes = table.breakdown(amount) if table else None
+        if notes is None or sum(notes.values()) > self.MAX_NOTES:
+            return None
+        return notes
+
+    def getBreakdown(self, amount):
+        with self.lock:
+            return self.breakdown(amount)
+
+    def canDispense(self, amount):
+        return self.getBreakdown(amount) is not None
+
     def dispenseCash(self, amount):
+        # returns {denomination: notes}, or None if the cassettes cannot make the amount
         with self.lock:
-            if amount > self.cash:
-                return False
-            self.cash -= amount
-            return True
-        
-    def depositCash(self, amount):
+            notes = self.breakdown(amount)
+            if notes is None:
+                return None
+            for denomination, count in notes.items():
+                self.cassettes[denomination] -= count
+            self.dispensed += amount
+            return notes
+
+    def depositCash(self, amount, notes=None):
+        # notes, when given, are recycled into the matching cassettes
+        with self.lock:
+            if notes:
+                for denomination, count in notes.items():
+                    self.cassettes[denomination] = self.cassettes.get(denomination, 0) + count
+            else:
+                self.depositBin += amount
+            self.accepted += amount
+
+    def refill(self, denomination, count):
         with self.lock:
-            self.cash += amount
+            self.cassettes[denomination] = self.cassettes.get(denomination, 0) + count
 
 # Transaction
 class Transaction(ABC):
@@ -90,26 +631,252 @@ class BalanceEnquiry:
         self.account = account
 
     def execute(self):
-        self.account.getBalance()
+        return self.account.getBalance()
 
 class CashWithdrawal:
-    def __init__(self, account, amount, dispenser):
+    def __init__(self, account, amount, dispenser, eventLog=None, atmId=0):
         self.account = account
         self.amount = amount
         self.dispenser = dispenser
+        self.eventLog = eventLog
+        self.atmId = atmId
+        self.notes = None
 
     def execute(self):
-        return self.account.withdraw(self.amount) and self.dispenser.dispenseCash(amount)
+        # check feasibility before debiting, and refund if another session emptied a cassette meanwhile
+        if self.eventLog is not None:
+            self.eventLog.check(self.atmId, self.account.getAccountId())
+        if self.amount <= 0 or not self.dispenser.canDispense(self.amount):
+            return False
+        if not self.account.withdraw(self.amount):
+            return False
+        self.notes = self.dispenser.dispenseCash(self.amount)
+        if self.notes is None:
+            self.account.deposit(self.amount)
+            return False
+        if self.eventLog is not None:
+            cash = sum(denomination * count for denomination, count in self.notes.items())
+            self.eventLog.record(self.atmId, self.account.getAccountId(), CashEvent.WITHDRAWAL, self.amount, cash)
+        return True
 
 class CashDeposit:
-    def __init__(self, account, amount, dispenser):
+    def __init__(self, account, amount, dispenser, eventLog=None, atmId=0):
         self.account = account
         self.amount = amount
         self.dispenser = dispenser
+        self.eventLog = eventLog
+        self.atmId = atmId
 
     def execute(self):
+        if self.eventLog is not None:
+            self.eventLog.check(self.atmId, self.account.getAccountId())
+        if self.amount <= 0:
+            return False
         self.account.deposit(self.amount)
         self.dispenser.depositCash(self.amount)
+        if self.eventLog is not None:
+            self.eventLog.record(self.atmId, self.account.getAccountId(), CashEvent.DEPOSIT, self.amount, self.amount)
+        return True
+
+# Cash Event Log
+# fixed-size records: timestamp, atmId, accountId, kind, ledger amount, cash amount; ids are stored as int64,
+# non-integer account ids as a stable negative hash listed in the log's account-keys.tsv
+class CashEvent:
+    WITHDRAWAL = 1
+    DEPOSIT = 2
+    RECORD = struct.Struct('<dqqBqq')
+    if np is not None:
+        DTYPE = np.dtype([("timestamp", "<f8"), ("atmId", "<i8"), ("accountId", "<i8"),
+                          ("kind", "u1"), ("ledger", "<i8"), ("cash", "<i8")])
+
+class CashEventLog:
+    def __init__(self, directory, shards=1):
+        # one file per ATM shard, so reconciliation can run a process per shard
+        os.makedirs(directory, exist_ok=True)
+        self.paths = [os.path.join(directory, f"cash-events-{i}.bin") for i in range(shards)]
+        self.files = [open(path, "ab") for path in self.paths]
+        self.locks = [Lock() for _ in range(shards)]
+        self.accountKeys = loadAccountKeys(directory)    # int64 key -> accountId, for non-integer ids
+        self.keysFile = open(os.path.join(directory, "account-keys.tsv"), "a")
+        self.keysLock = Lock()
+
+    def getPaths(self):
+        return list(self.paths)
+
+    def accountKey(self, accountId):
+        if isinstance(accountId, int) and not isinstance(accountId, bool) and -2 ** 63 <= accountId < 2 ** 63:
+            return accountId
+        name = str(accountId)
+        key = -(int.from_bytes(hashlib.blake2b(name.encode(), digest_size=8).digest(), "little") >> 1) - 1
+        if key not in self.accountKeys:
+            with self.keysLock:
+                if key not in self.accountKeys:
+                    self.keysFile.write(f"{key}\t{name}\n")
+                    self.keysFile.flush()
+                    self.accountKeys[key] = name
+        return key
+
+    def check(self, atmId, accountId):
+        # raises ValueError if an event could not be recorded; transactions call it before moving any money
+        if isinstance(atmId, bool) or not isinstance(atmId, int) or not -2 ** 63 <= atmId < 2 ** 63:
+            raise ValueError(f"atmId must fit in an int64, got {atmId!r}")
+        return self.accountKey(accountId)
+
+    def record(self, atmId, accountId, kind, ledgerAmount, cashAmount):
+        shard = atmId % len(self.files)
+        data = CashEvent.RECORD.pack(time.time(), atmId, self.accountKey(accountId), kind, ledgerAmount, cashAmount)
+        with self.locks[shard]:
+            self.files[shard].write(data)
+
+    def flush(self):
+        for lock, f in zip(self.locks, self.files):
+            with lock:
+                f.flush()
+
+    def close(self):
+        self.flush()
+        for f in self.files:
+            f.close()
+        self.keysFile.close()
+
+def loadAccountKeys(directory):
+    # int64 key -> accountId as written by CashEventLog.accountKey
+    res = {}
+    path = os.path.join(directory, "account-keys.tsv")
+    if os.path.exists(path):
+        with open(path) as f:
+            for line in f:
+                key, _, name = line.rstrip("\n").partition("\t")
+                if name:
+                    res[int(key)] = name
+    return res
+
+# Reconciliation
+class ReconciliationTotals:
+    def __init__(self):
+        self.atms = {}    # atmId -> [ledgerWithdrawn, cashDispensed, ledgerDeposited, cashAccepted, events]
+        self.accounts = {}    # accountId -> [withdrawn, deposited]
+        self.events = 0
+        self.mismatchedEvents = 0
+
+    def addAtm(self, atmId, ledgerWithdrawn, cashDispensed, ledgerDeposited, cashAccepted, events):
+        totals = self.atms.setdefault(atmId, [0, 0, 0, 0, 0])
+        totals[0] += ledgerWithdrawn
+        totals[1] += cashDispensed
+        totals[2] += ledgerDeposited
+        totals[3] += cashAccepted
+        totals[4] += events
+
+    def addAccount(self, accountId, withdrawn, deposited):
+        totals = self.accounts.setdefault(accountId, [0, 0])
+        totals[0] += withdrawn
+        totals[1] += deposited
+
+    def merge(self, other):
+        for atmId, totals in other.atms.items():
+            self.addAtm(atmId, *totals)
+        for accountId, totals in other.accounts.items():
+            self.addAccount(accountId, *totals)
+        self.events += other.events
+        self.mismatchedEvents += other.mismatchedEvents
+        return self
+
+def readEventChunks(path, chunkEvents=1 << 16):
+    # yields raw byte chunks holding whole records, so memory stays bounded by chunkEvents
+    chunkBytes = chunkEvents * CashEvent.RECORD.size
+    with open(path, "rb") as f:
+        while True:
+            data = f.read(chunkBytes)
+            if not data:
+                return
+            yield data[:len(data) - len(data) % CashEvent.RECORD.size]
+
+def groupSums(ids, *columns):
+    # sums each int64 column per distinct id within one chunk
+    keys, inverse = np.unique(ids, return_inverse=True)
+    res = []
+    for column in columns:
+        sums = np.zeros(len(keys), dtype=np.int64)
+        np.add.at(sums, inverse, column)
+        res.append(sums.tolist())
+    return keys.tolist(), res
+
+def aggregateChunk(totals, data):
+    if np is not None:
+        events = np.frombuffer(data, dtype=CashEvent.DTYPE)
+        withdrawal = events["kind"] == CashEvent.WITHDRAWAL
+        ledgerOut = np.where(withdrawal, events["ledger"], 0)
+        cashOut = np.where(withdrawal, events["cash"], 0)
+        ledgerIn = events["ledger"] - ledgerOut
+        cashIn = events["cash"] - cashOut
+        totals.events += len(events)
+        totals.mismatchedEvents += int(np.count_nonzero(events["ledger"] != events["cash"]))
+        atmIds, (a, b, c, d, n) = groupSums(events["atmId"], ledgerOut, cashOut, ledgerIn, cashIn, np.ones(len(events), dtype=np.int64))
+        for i, atmId in enumerate(atmIds):
+            totals.addAtm(atmId, a[i], b[i], c[i], d[i], n[i])
+        accountIds, (out, into) = groupSums(events["accountId"], ledgerOut, ledgerIn)
+        for i, accountId in enumerate(accountIds):
+            totals.addAccount(accountId, out[i], into[i])
+        return
+    for _, atmId, accountId, kind, ledger, cash in CashEvent.RECORD.iter_unpack(data):
+        totals.events += 1
+        if ledger != cash:
+            totals.mismatchedEvents += 1
+        if kind == CashEvent.WITHDRAWAL:
+            totals.addAtm(atmId, ledger, cash, 0, 0, 1)
+            totals.addAccount(accountId, ledger, 0)
+        else:
+            totals.addAtm(atmId, 0, 0, ledger, cash, 1)
+            totals.addAccount(accountId, 0, ledger)
+
+def reconcileFile(path, chunkEvents=1 << 16):
+    totals = ReconciliationTotals()
+    for data in readEventChunks(path, chunkEvents):
+        aggregateChunk(totals, data)
+    return totals
+
+def reconcile(paths, dispensers=None, workers=1, chunkEvents=1 << 16, accountKeys=None):
+    # streams every shard file and merges the totals; shards run in separate processes when workers > 1
+    totals = ReconciliationTotals()
+    if workers > 1 and len(paths) > 1:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            for shardTotals in pool.map(reconcileFile, paths, [chunkEvents] * len(paths)):
+                totals.merge(shardTotals)
+    else:
+        for path in paths:
+            totals.merge(reconcileFile(path, chunkEvents))
+    if dispensers is not None:
+        dispensers = {atmId: dispenser.getCounters() for atmId, dispenser in dispensers.items()}
+    return summarise(totals, dispensers, accountKeys)
+
+def summarise(totals, dispensers=None, accountKeys=None):
+    # dispensers, if given, maps atmId -> (dispensed, accepted) as counted by the dispenser itself;
+    # accountKeys, from loadAccountKeys, turns hashed account keys back into their ids
+    mismatches = []
+    for atmId, (ledgerWithdrawn, cashDispensed, ledgerDeposited, cashAccepted, _) in sorted(totals.atms.items()):
+        if ledgerWithdrawn != cashDispensed or ledgerDeposited != cashAccepted:
+            mismatches.append(atmId)
+        elif dispensers is not None and atmId in dispensers and dispensers[atmId] != (cashDispensed, cashAccepted):
+            mismatches.append(atmId)
+    return {
+        "events": totals.events,
+        "mismatchedEvents": totals.mismatchedEvents,
+        "atms": {atmId: dict(zip(("ledgerWithdrawn", "cashDispensed", "ledgerDeposited", "cashAccepted", "events"), t))
+                 for atmId, t in totals.atms.items()},
+        "accounts": {(accountKeys or {}).get(accountId, accountId): {"withdrawn": t[0], "deposited": t[1]}
+                     for accountId, t in totals.accounts.items()},
+        "mismatchedAtms": mismatches,
+    }
+
+def reconciliationReport(summary):
+    lines = [f"events: {summary['events']}",
+             f"mismatched events: {summary['mismatchedEvents']}",
+             f"atms: {len(summary['atms'])}, accounts: {len(summary['accounts'])}"]
+    for atmId, t in sorted(summary["atms"].items()):
+        flag = "  MISMATCH" if atmId in summary["mismatchedAtms"] else ""
+        lines.append(f"atm {atmId}: withdrawn {t['ledgerWithdrawn']}/{t['cashDispensed']} "
+                     f"deposited {t['ledgerDeposited']}/{t['cashAccepted']} events {t['events']}{flag}")
+    return "\n".join(lines)
 
 # ATM
 class ATM:
@@ -132,6 +899,329 @@ class ATM:
             return True
         return False
     
+    def getCurrCard(self):
+        return self.currCard
+
+    def isAuthenticated(self):
+        return self.authenticated
+
     def ejectCard(self):
         self.currCard = None
-        self.authenticated = False
\ No newline at end of file
+        self.authenticated = False
+
+# ATM Session Server
+# frame: 4-byte big-endian length + JSON object; every request carries an "id" echoed in its response
+class FrameCodec:
+    HEADER = struct.Struct('>I')
+    MAX_FRAME = 1 << 20
+
+    @staticmethod
+    def encode(message):
+        body = json.dumps(message).encode()
+        return FrameCodec.HEADER.pack(len(body)) + body
+
+    @staticmethod
+    async def read(reader):
+        header = await reader.readexactly(FrameCodec.HEADER.size)
+        length = FrameCodec.HEADER.unpack(header)[0]
+        if length > FrameCodec.MAX_FRAME:
+            raise ValueError("frame too large")
+        message = json.loads(await reader.readexactly(length))
+        if not isinstance(message, dict):
+            raise ValueError("frame is not a JSON object")
+        return message
+
+class ATMSession:
+    def __init__(self, terminalId, atm):
+        self.terminalId = terminalId
+        self.atm = atm
+        self.lastActive = time.monotonic()
+
+    def touch(self):
+        self.lastActive = time.monotonic()
+
+class ATMSessionServer:
+    IDLE_TIMEOUT = 120.0    # seconds without a request before a session is closed
+
+    def __init__(self, bankServer, dispensers):
+        self.bankServer = bankServer
+        self.dispensers = dispensers    # terminalId -> CashDispenser
+        self.sessions = {}    # terminalId -> ATMSession
+        self.server = None
+
+    async def start(self, path=None, host="127.0.0.1", port=0):
+        # a unix socket when path is given, otherwise TCP on localhost
+        if path is not None:
+            self.server = await asyncio.start_unix_server(self.handle, path=path)
+        else:
+            self.server = await asyncio.start_server(self.handle, host, port)
+        return self.server
+
+    def getAddress(self):
+        return self.server.sockets[0].getsockname()
+
+    async def stop(self):
+        self.server.close()
+        await self.server.wait_closed()
+
+    async def handle(self, reader, writer):
+        session = None
+        try:
+            hello = await asyncio.wait_for(FrameCodec.read(reader), self.IDLE_TIMEOUT)
+            terminalId = hello.get("terminal")
+            if not self.isId(terminalId) or terminalId not in self.dispensers or terminalId in self.sessions:
+                writer.write(FrameCodec.encode({"id": hello.get("id"), "ok": False, "error": "unknown or busy terminal"}))
+                return
+            session = ATMSession(terminalId, ATM(self.bankServer, self.dispensers[terminalId]))
+            self.sessions[terminalId] = session
+            writer.write(FrameCodec.encode({"id": hello.get("id"), "ok": True}))
+            # clients may pipeline; queued requests are served in order, so responses keep request order
+            while True:
+                request = await asyncio.wait_for(FrameCodec.read(reader), self.IDLE_TIMEOUT)
+                session.touch()
+                response = await self.dispatch(session, request)
+                response["id"] = request.get("id")
+                writer.write(FrameCodec.encode(response))
+                await writer.drain()
+                if request.get("op") == "logout":
+                    return
+        except (asyncio.IncompleteReadError, asyncio.TimeoutError, ConnectionError, ValueError):
+            pass
+        finally:
+            if session is not None:
+                session.atm.ejectCard()
+                self.sessions.pop(session.terminalId, None)
+            writer.close()
+
+    @staticmethod
+    def isId(value):
+        # terminal ids, card numbers and PINs arrive as JSON strings or integers
+        return isinstance(value, (str, int)) and not isinstance(value, bool)
+
+    @staticmethod
+    def parseAmount(request):
+        # a positive whole number, or None
+        amount = request.get("amount")
+        if isinstance(amount, bool) or not isinstance(amount, int) or amount <= 0:
+            return None
+        return amount
+
+    async def dispatch(self, session, request):
+        # bank calls may block on PIN hashing or journal fsync, so they run off the event loop
+        atm = session.atm
+        op = request.get("op")
+        if op == "login":
+            if not self.isId(request.get("cardNo")) or not self.isId(request.get("pin")):
+                return {"ok": False, "error": "cardNo and pin must be strings or integers"}
+            ok = await asyncio.to_thread(atm.insertCard, request.get("cardNo"), request.get("pin"))
+            return {"ok": ok}
+        if op == "logout":
+            atm.ejectCard()
+            return {"ok": True}
+        if not atm.isAuthenticated():
+            return {"ok": False, "error": "not authenticated"}
+        account = self.bankServer.getAccount(atm.getCurrCard())
+        if op == "balance":
+            return {"ok": True, "balance": await asyncio.to_thread(BalanceEnquiry(account).execute)}
+        if op in ("withdraw", "deposit") and self.parseAmount(request) is None:
+            return {"ok": False, "error": "amount must be a positive whole number"}
+        if op == "withdraw":
+            transaction = CashWithdrawal(account, self.parseAmount(request), atm.dispenser)
+            ok = await asyncio.to_thread(transaction.execute)
+            return {"ok": ok, "notes": {str(d): n for d, n in (transaction.notes or {}).items()}}
+        if op == "deposit":
+            ok = await asyncio.to_thread(CashDeposit(account, self.parseAmount(request), atm.dispenser).execute)
+            return {"ok": ok}
+        return {"ok": False, "error": f"unknown op {op}"}
+
+# ATM Client Simulator
+class ATMClient:
+    def __init__(self, terminalId):
+        self.terminalId = terminalId
+        self.reader = None
+        self.writer = None
+        self.nextId = 0
+
+    async def connect(self, path=None, host="127.0.0.1", port=None):
+        if path is not None:
+            self.reader, self.writer = await asyncio.open_unix_connection(path)
+        else:
+            self.reader, self.writer = await asyncio.open_connection(host, port)
+        return (await self.pipeline([{"terminal": self.terminalId}]))[0]["ok"]
+
+    async def pipeline(self, requests):
+        # sends every request before reading any response
+        for request in requests:
+            self.nextId += 1
+            request["id"] = self.nextId
+            self.writer.write(FrameCodec.encode(request))
+        await self.writer.drain()
+        return [await FrameCodec.read(self.reader) for _ in requests]
+
+    async def close(self):
+        self.writer.close()
+        await self.writer.wait_closed()
+
+async def simulateFleet(bankServer, cards, terminals=100, rounds=10, path=None):
+    # cards is a list of (cardNo, PIN); each terminal logs in and pipelines a batch of requests per round
+    dispensers = {f"T{i}": CashDispenser({20: 2000, 50: 2000, 100: 2000}) for i in range(terminals)}
+    server = ATMSessionServer(bankServer, dispensers)
+    await server.start(path=path)
+    port = None if path is not None else server.getAddress()[1]
+
+    async def terminal(i):
+        client = ATMClient(f"T{i}")
+        await client.connect(path=path, port=port)
+        cardNo, PIN = cards[i % len(cards)]
+        results = await client.pipeline([{"op": "login", "cardNo": cardNo, "pin": PIN}])
+        for _ in range(rounds):
+            results += await client.pipeline([
+                {"op": "balance"},
+                {"op": "deposit", "amount": 100},
+                {"op": "withdraw", "amount": 60},
+                {"op": "balance"},
+            ])
+        results += await client.pipeline([{"op": "logout"}])
+        await client.close()
+        return results
+
+    start = time.perf_counter()
+    results = await asyncio.gather(*(terminal(i) for i in range(terminals)))
+    elapsed = time.perf_counter() - start
+    await server.stop()
+    requests = sum(len(r) for r in results)
+    return {"terminals": terminals, "requests": requests, "elapsed": elapsed, "requestsPerSecond": requests / elapsed}
+
+# Benchmark
+class TimedLock:
+    def __init__(self):
+        self.lock = Lock()
+        self.statsLock = Lock()
+        self.waitTime = 0.0
+        self.acquisitions = 0
+
+    def acquire(self):
+        start = time.perf_counter()
+        self.lock.acquire()
+        waited = time.perf_counter() - start
+        with self.statsLock:
+            self.waitTime += waited
+            self.acquisitions += 1
+        return True
+
+    def release(self):
+        self.lock.release()
+
+    def __enter__(self):
+        return self.acquire()
+
+    def __exit__(self, *args):
+        self.release()
+
+class ATMBenchmark:
+    MIX = (("insertCard", 0.1), ("balance", 0.4), ("withdraw", 0.3), ("deposit", 0.2))
+
+    def __init__(self, accounts=10000, cards=10000, dispensers=8, threads=16, opsPerThread=2000,
+                 zipfSkew=1.1, initialBalance=100000, pinHashIterations=1000, numShards=64, seed=None):
+        self.accounts = accounts
+        self.cards = cards
+        self.dispensers = dispensers
+        self.threads = threads
+        self.opsPerThread = opsPerThread
+        self.zipfSkew = zipfSkew    # 0 is uniform; larger values concentrate load on a few hot accounts
+        self.initialBalance = initialBalance
+        self.pinHashIterations = pinHashIterations
+        self.numShards = numShards
+        self.seed = seed
+        self.latencies = {}    # op -> list of seconds
+        self.deposited = 0
+        self.withdrawn = 0
+        self.statsLock = Lock()
+
+    def build(self):
+        self.bankServer = BankServer(self.numShards)
+        for shard in self.bankServer.accounts.shards:
+            shard.lock = TimedLock()
+        for accountId in range(self.accounts):
+            self.bankServer.addAccount(Account(accountId, self.initialBalance))
+        # cheaper PIN hashing keeps seeding fast
+        for cardNo in range(self.cards):
+            self.bankServer.addCard(Card(cardNo, 1000 + cardNo % 9000, cardNo % self.accounts, self.pinHashIterations))
+        self.cashDispensers = []
+        for _ in range(self.dispensers):
+            dispenser = CashDispenser({20: 10 ** 6, 50: 10 ** 6, 100: 10 ** 6})
+            dispenser.lock = TimedLock()
+            self.cashDispensers.append(dispenser)
+        self.initialCash = sum(d.getCash() for d in self.cashDispensers)
+        weights = [1 / (rank ** self.zipfSkew) for rank in range(1, self.cards + 1)]
+        self.cumWeights = list(itertools.accumulate(weights))
+
+    def worker(self, workerId):
+        rng = random.Random(None if self.seed is None else self.seed + workerId)
+        ops, opWeights = zip(*self.MIX)
+        latencies = {op: [] for op in ops}
+        deposited = withdrawn = 0
+        atm = ATM(self.bankServer, self.cashDispensers[workerId % len(self.cashDispensers)])
+        for _ in range(self.opsPerThread):
+            op = rng.choices(ops, opWeights)[0]
+            cardNo = rng.choices(range(self.cards), cum_weights=self.cumWeights)[0]
+            account = self.bankServer.getAccount(cardNo)
+            amount = rng.choice((20, 40, 60, 100, 200))
+            start = time.perf_counter()
+            if op == "insertCard":
+                atm.insertCard(cardNo, 1000 + cardNo % 9000)
+                atm.ejectCard()
+            elif op == "balance":
+                BalanceEnquiry(account).execute()
+            elif op == "withdraw":
+                if CashWithdrawal(account, amount, atm.dispenser).execute():
+                    withdrawn += amount
+            else:
+                CashDeposit(account, amount, atm.dispenser).execute()
+                deposited += amount
+            latencies[op].append(time.perf_counter() - start)
+        with self.statsLock:
+            for op, values in latencies.items():
+                self.latencies.setdefault(op, []).extend(values)
+            self.deposited += deposited
+            self.withdrawn += withdrawn
+
+    def run(self):
+        self.build()
+        start = time.perf_counter()
+        workers = [Thread(target=self.worker, args=(i,)) for i in range(self.threads)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        return self.report(time.perf_counter() - start)
+
+    def percentile(self, values, pct):
+        values = sorted(values)
+        return values[min(len(values) - 1, int(len(values) * pct / 100))] if values else 0.0
+
+    def lockStats(self, locks):
+        waitTime = sum(lock.waitTime for lock in locks)
+        acquisitions = sum(lock.acquisitions for lock in locks)
+        return {"waitTime": waitTime, "waitPerAcquisition": waitTime / acquisitions if acquisitions else 0.0}
+
+    def report(self, elapsed):
+        totalOps = sum(len(values) for values in self.latencies.values())
+        res = {"elapsed": elapsed, "opsPerSecond": totalOps / elapsed, "ops": {}}
+        for op, values in self.latencies.items():
+            res["ops"][op] = {
+                "count": len(values),
+                "p50": self.percentile(values, 50),
+                "p99": self.percentile(values, 99),
+                "p999": self.percentile(values, 99.9),
+            }
+        res["shardLocks"] = self.lockStats([shard.lock for shard in self.bankServer.accounts.shards])
+        res["dispenserLocks"] = self.lockStats([d.lock for d in self.cashDispensers])
+        # money is conserved: every withdrawal left a cassette and every deposit entered one
+        ledger = sum(self.bankServer.getAccountById(i).getBalance() for i in range(self.accounts))
+        expectedLedger = self.accounts * self.initialBalance + self.deposited - self.withdrawn
+        cash = sum(d.getCash() + d.depositBin for d in self.cashDispensers)
+        expectedCash = self.initialCash - self.withdrawn + self.deposited
+        res["balanceConserved"] = ledger == expectedLedger and cash == expectedCash
+        assert res["balanceConserved"], f"ledger {ledger} != {expectedLedger} or cash {cash} != {expectedCash}"
+        return res
@@ -1,3 +1,20 @@
+from enum import Enum
+from abc import ABC, abstractmethod
+from threading import Lock, Thread, Event, Barrier, Condition, Timer, local
+from datetime import datetime
+import bisect
+import heapq
+import math
+import pickle
+import os
+import json
+from collections import deque
+from itertools import islice
+import re
+import time
+import random
+from queue import Queue, Empty
+
 # Enums
 class PaymentStatus(Enum):
     PENDING = 1
@@ -30,7 +47,6 @@ class Customer(Person):
         self.address = address
         self.contact = contact
         self.cart = Cart(self)
-        self.orderHistory = []    # list of Order
 
     def getAddress(self):
         return self.address
@@ -40,12 +56,20 @@ class Customer(Person):
     
     def getCartTotal(self):
         return self.cart.getCartTotal()
+
+    def getCart(self):
+        return self.cart
     
     def clearCart(self):
+        # anything still reserved for the old cart goes back on the shelf
+        ReservationManager().releaseAll(self.cart)
         self.cart = Cart(self)
 
     def addToOrderHistory(self, order):
-        self.orderHistory.append(order)
+        OrderManager().history.add(self.id, order)
+
+    def getOrderHistory(self, limit=20, cursor=None):
+        return OrderManager().history.page(self.id, limit, cursor)
 
 class Seller(Person):
     def __init__(self, id, name):
@@ -53,7 +77,7 @@ class Seller(Person):
         self.products = []    # list of Product
 
     def createProduct(self, productId, name, price, stock):
-        newProduct = Product(productId, name, price, stock)
+        newProduct = Product(productId, name, price, stock, self)
         self.products.append(newProduct)
         return newProduct
 
@@ -62,40 +86,218 @@ class Seller(Person):
     
 # Product
 class Product:
-    def __init__(id, name, price, stock, seller=None):
+    def __init__(self, id, name, price, stock, seller=None):
         self.id = id
         self.name = name
         self.price = price
         self.stock = stock
         self.seller = seller
+        self.inventory = None    # set by Inventory.addProduct, notified of stock changes
         self.lock = Lock()
 
+    def getId(self):
+        return self.id
+
+    def getName(self):
+        return self.name
+
+    def getStock(self):
+        return self.stock
+
+    def getSeller(self):
+        return self.seller
+
     def isAvailable(self, quantity):
         return self.stock >= quantity
     
+    # the inventory is only notified when stock crosses zero, so ordinary sales never touch its lock
     def removeStock(self, quantity):
         with self.lock:
-            if self.isAvailable(quantity):
-                self.stock -= quantity
-                return True
-            return False
+            if not self.isAvailable(quantity):
+                return False
+            emptied = self.stock > 0 and self.stock - quantity <= 0
+            self.stock -= quantity
+        if emptied and self.inventory is not None:
+            self.inventory.stockChanged(self)
+        return True
         
     def addStock(self, quantity):
         with self.lock:
+            restocked = self.stock <= 0 and self.stock + quantity > 0
             self.stock += quantity
+        if restocked and self.inventory is not None:
+            self.inventory.stockChanged(self)
 
     def getPrice(self):
         return self.price
 
+# Product Search
+class ProductSearchIndex:
+    K1 = 1.2
+    B = 0.75
+    PREFIX_EXPANSIONS = 50    # terms a trailing prefix may expand to
+    TOKEN = re.compile(r"[a-z0-9]+")
+
+    def __init__(self):
+        self.postings = {}    # term -> {productId: term frequency}
+        self.terms = []    # sorted terms, for prefix lookups
+        self.docLengths = {}    # productId -> number of tokens
+        self.termsOf = {}    # productId -> distinct terms, so removal touches only its own postings
+        self.totalLength = 0
+        self.lock = Lock()
+
+    @classmethod
+    def tokenize(cls, text):
+        return cls.TOKEN.findall(text.lower())
+
+    def add(self, productId, name):
+        tokens = self.tokenize(name)
+        with self.lock:
+            if productId in self.docLengths:
+                self.removeLocked(productId)
+            counts = {}
+            for token in tokens:
+                counts[token] = counts.get(token, 0) + 1
+            for term, tf in counts.items():
+                if term not in self.postings:
+                    self.postings[term] = {}
+                    bisect.insort(self.terms, term)
+                self.postings[term][productId] = tf
+            self.docLengths[productId] = len(tokens)
+            self.termsOf[productId] = tuple(counts)
+            self.totalLength += len(tokens)
+
+    def remove(self, productId):
+        with self.lock:
+            self.removeLocked(productId)
+
+    def removeLocked(self, productId):
+        # caller must hold self.lock; only the product's own terms are visited
+        if productId not in self.docLengths:
+            return
+        self.totalLength -= self.docLengths.pop(productId)
+        for term in self.termsOf.pop(productId, ()):
+            posting = self.postings.get(term)
+            if posting is None:
+                continue
+            posting.pop(productId, None)
+            if not posting:
+                del self.postings[term]
+                del self.terms[bisect.bisect_left(self.terms, term)]
+
+    def expand(self, prefix):
+        # caller must hold self.lock
+        idx = bisect.bisect_left(self.terms, prefix)
+        res = []
+        while idx < len(self.terms) and self.terms[idx].startswith(prefix) and len(res) < self.PREFIX_EXPANSIONS:
+            res.append(self.terms[idx])
+            idx += 1
+        return res
+
+    def autocomplete(self, prefix, limit=10):
+        # completions of the last word of prefix, most common first
+        tokens = self.tokenize(prefix)
+        if not tokens:
+            return []
+        with self.lock:
+            terms = self.expand(tokens[-1])
+            return heapq.nlargest(limit, terms, key=lambda term: len(self.postings[term]))
+
+    def search(self, query, limit=10, accept=None, prefix=True):
+        # BM25 over product names; the last query word also matches as a prefix.
+        # accept, if given, filters productIds before ranking. Returns [(productId, score)].
+        tokens = self.tokenize(query)
+        if not tokens:
+            return []
+        with self.lock:
+            n = len(self.docLengths)
+            if n == 0:
+                return []
+            avgLength = self.totalLength / n
+            queryTerms = [[token] for token in tokens]
+            if prefix:
+                queryTerms[-1] = self.expand(tokens[-1]) or [tokens[-1]]
+            scores = {}
+            for alternatives in queryTerms:
+                best = {}    # a prefix counts once per product, via its best-scoring expansion
+                for term in alternatives:
+                    posting = self.postings.get(term)
+                    if not posting:
+                        continue
+                    idf = math.log(1 + (n - len(posting) + 0.5) / (len(posting) + 0.5))
+                    for productId, tf in posting.items():
+                        norm = tf + self.K1 * (1 - self.B + self.B * self.docLengths[productId] / avgLength)
+                        score = idf * tf * (self.K1 + 1) / norm
+                        if score > best.get(productId, 0.0):
+                            best[productId] = score
+                for productId, score in best.items():
+                    scores[productId] = scores.get(productId, 0.0) + score
+        if accept is not None:
+            scores = {productId: score for productId, score in scores.items() if accept(productId)}
+        return heapq.nlargest(limit, scores.items(), key=lambda item: item[1])
+
+    def save(self, path):
+        with self.lock:
+            with open(path, "wb") as f:
+                pickle.dump((self.postings, self.terms, self.docLengths, self.termsOf, self.totalLength), f, protocol=pickle.HIGHEST_PROTOCOL)
+
+    @classmethod
+    def load(cls, path):
+        index = cls()
+        with open(path, "rb") as f:
+            index.postings, index.terms, index.docLengths, index.termsOf, index.totalLength = pickle.load(f)
+        return index
+
 # Inventory
 class Inventory:
     def __init__(self):
         self.products = {}    # productId -> Product
+        self.bySeller = {}    # sellerId -> set of productIds
+        self.byPrice = []    # sorted list of (price, productId)
+        self.inStock = set()    # productIds with stock > 0
+        self.searchIndex = ProductSearchIndex()
         self.lock = Lock()
 
     def addProduct(self, product):
         with self.lock:
-            self.products[product.getId()] = product
+            productId = product.getId()
+            if productId in self.products:
+                self.unindex(self.products[productId])
+            self.products[productId] = product
+            product.inventory = self
+            if product.getSeller() is not None:
+                self.bySeller.setdefault(product.getSeller().getID(), set()).add(productId)
+            bisect.insort(self.byPrice, (product.getPrice(), productId))
+            if product.getStock() > 0:
+                self.inStock.add(productId)
+            self.searchIndex.add(productId, product.getName())
+
+    def unindex(self, product):
+        # caller must hold self.lock
+        productId = product.getId()
+        if product.getSeller() is not None:
+            sellerProducts = self.bySeller.get(product.getSeller().getID())
+            if sellerProducts is not None:
+                sellerProducts.discard(productId)
+                if not sellerProducts:
+                    del self.bySeller[product.getSeller().getID()]
+        idx = bisect.bisect_left(self.byPrice, (product.getPrice(), productId))
+        if idx < len(self.byPrice) and self.byPrice[idx] == (product.getPrice(), productId):
+            del self.byPrice[idx]
+        self.inStock.discard(productId)
+        self.searchIndex.remove(productId)
+        product.inventory = None
+
+    def stockChanged(self, product):
+        # reads the current stock, so out-of-order notifications still converge
+        with self.lock:
+            productId = product.getId()
+            if self.products.get(productId) is not product:
+                return
+            if product.getStock() > 0:
+                self.inStock.add(productId)
+            else:
+                self.inStock.discard(productId)
 
     def getProductById(self, productId):
         if productId in self.products:
@@ -105,11 +307,251 @@ class Inventory:
     def removeProduct(self, productId):
         with self.lock:
             if productId in self.products:
+                self.unindex(self.products[productId])
                 del self.products[productId]
 
     def listProducts(self):
         return list(self.products.values())
+
+    def getProductsBySeller(self, sellerId):
+        with self.lock:
+            return [self.products[productId] for productId in self.bySeller.get(sellerId, ())]
+
+    def query(self, sellerId=None, minPrice=None, maxPrice=None, inStockOnly=False, limit=50, cursor=None):
+        # keyset pagination in price order; returns (products, nextCursor), nextCursor is None on the last page
+        if limit <= 0:
+            return [], cursor    # nothing consumed, so the caller's cursor is still the right place to resume
+        with self.lock:
+            sellerProducts = self.bySeller.get(sellerId, set()) if sellerId is not None else None
+            if sellerProducts is not None and len(sellerProducts) < len(self.byPrice) // 8:
+                # a small seller is cheaper to sort than to walk the whole price index for
+                entries = sorted((self.products[productId].getPrice(), productId) for productId in sellerProducts)
+            else:
+                entries = self.byPrice
+            if cursor is not None:
+                idx = bisect.bisect_right(entries, cursor)
+            elif minPrice is not None:
+                idx = bisect.bisect_left(entries, (minPrice,))
+            else:
+                idx = 0
+            res = []
+            while idx < len(entries) and len(res) < limit:
+                price, productId = entries[idx]
+                idx += 1
+                if minPrice is not None and price < minPrice:
+                    continue
+                if maxPrice is not None and price > maxPrice:
+                    break
+                if sellerProducts is not None and productId not in sellerProducts:
+                    continue
+                if inStockOnly and productId not in self.inStock:
+                    continue
+                res.append(self.products[productId])
+            nextCursor = None
+            if len(res) == limit and idx < len(entries):
+                nextCursor = (res[-1].getPrice(), res[-1].getId())
+            return res, nextCursor
+
+    def search(self, query, limit=10, minPrice=None, maxPrice=None, inStockOnly=False):
+        def accept(productId):
+            product = self.products.get(productId)
+            if product is None:
+                return False
+            if minPrice is not None and product.getPrice() < minPrice:
+                return False
+            if maxPrice is not None and product.getPrice() > maxPrice:
+                return False
+            return not inStockOnly or productId in self.inStock
+        hits = self.searchIndex.search(query, limit, accept)
+        return [self.products[productId] for productId, _ in hits if productId in self.products]
+
+    def autocomplete(self, prefix, limit=10):
+        return self.searchIndex.autocomplete(prefix, limit)
+
+    def saveSearchIndex(self, path):
+        self.searchIndex.save(path)
+
+    def loadSearchIndex(self, path):
+        # warm start; the saved index must describe the products currently in the inventory
+        self.searchIndex = ProductSearchIndex.load(path)
+
+    def topK(self, k, highest=False, sellerId=None, inStockOnly=True):
+        # the k cheapest (or most expensive) matching products
+        with self.lock:
+            entries = reversed(self.byPrice) if highest else iter(self.byPrice)
+            sellerProducts = self.bySeller.get(sellerId, set()) if sellerId is not None else None
+            res = []
+            for _, productId in entries:
+                if len(res) == k:
+                    break
+                if sellerProducts is not None and productId not in sellerProducts:
+                    continue
+                if inStockOnly and productId not in self.inStock:
+                    continue
+                res.append(self.products[productId])
+            return res
     
+# Stock Reservation
+class ReservationStripe:
+    def __init__(self):
+        self.holds = {}    # cartKey -> {productId: [product, quantity, deadline]}
+        self.expiry = []    # min-heap of (deadline, cartKey, productId)
+        self.lock = Lock()
+
+class ReservationManager:
+    _instance = None
+    _lock = Lock()
+    RESERVATION_TTL = 15 * 60    # seconds a cart keeps stock without checking out
+    NUM_STRIPES = 64
+
+    def __new__(cls):
+        with cls._lock:
+            if not cls._instance:
+                cls._instance = super().__new__(cls)
+                cls._instance.setup()
+        return cls._instance
+
+    def setup(self):
+        self.stripes = [ReservationStripe() for _ in range(self.NUM_STRIPES)]
+        self.stopped = Event()
+        self.thread = None
+
+    def stripeFor(self, cartKey):
+        return self.stripes[hash(cartKey) % len(self.stripes)]
+
+    @staticmethod
+    def cartKey(cart):
+        return cart.customer.getID()
+
+    @staticmethod
+    def takeStock(quantities):
+        # atomically takes {product: quantity}; product locks are taken in productId order so
+        # concurrent multi-product checkouts cannot deadlock
+        products = sorted(quantities, key=lambda product: product.getId())
+        emptied = []
+        for product in products:
+            product.lock.acquire()
+        try:
+            for product in products:
+                if not product.isAvailable(quantities[product]):
+                    return False
+            for product in products:
+                if product.stock > 0 and product.stock - quantities[product] <= 0:
+                    emptied.append(product)
+                product.stock -= quantities[product]
+        finally:
+            for product in reversed(products):
+                product.lock.release()
+        for product in emptied:
+            if product.inventory is not None:
+                product.inventory.stockChanged(product)
+        return True
+
+    @staticmethod
+    def returnStock(quantities):
+        for product, quantity in quantities.items():
+            if quantity > 0:
+                product.addStock(quantity)
+
+    def reserve(self, cart, product, quantity):
+        # only the caller's stripe is swept inline; other stripes are left to the start() reaper
+        cartKey = self.cartKey(cart)
+        stripe = self.stripeFor(cartKey)
+        self.expireStripe(stripe, time.monotonic())
+        if not product.removeStock(quantity):
+            # without a reaper, lapsed holds elsewhere would never come back, so sweep once before giving up
+            if self.thread is not None:
+                return False
+            self.expire()
+            if not product.removeStock(quantity):
+                return False
+        deadline = time.monotonic() + self.RESERVATION_TTL
+        with stripe.lock:
+            holds = stripe.holds.setdefault(cartKey, {})
+            if product.getId() in holds:
+                holds[product.getId()][1] += quantity
+                holds[product.getId()][2] = deadline
+            else:
+                holds[product.getId()] = [product, quantity, deadline]
+            heapq.heappush(stripe.expiry, (deadline, cartKey, product.getId()))
+        return True
+
+    def release(self, cart, product, quantity):
+        cartKey = self.cartKey(cart)
+        stripe = self.stripeFor(cartKey)
+        with stripe.lock:
+            holds = stripe.holds.get(cartKey, {})
+            hold = holds.get(product.getId())
+            if hold is None:
+                return
+            quantity = min(quantity, hold[1])
+            hold[1] -= quantity
+            if hold[1] == 0:
+                del holds[product.getId()]
+                if not holds:
+                    del stripe.holds[cartKey]
+        self.returnStock({product: quantity})
+
+    def releaseAll(self, cart):
+        cartKey = self.cartKey(cart)
+        stripe = self.stripeFor(cartKey)
+        with stripe.lock:
+            holds = stripe.holds.pop(cartKey, {})
+        self.returnStock({product: quantity for product, quantity, _ in holds.values()})
+
+    def checkout(self, cart, items):
+        # consumes the cart's reservations for items ({product: quantity}); anything that lapsed is
+        # re-taken atomically. Returns False, with reservations untouched, if stock ran out.
+        cartKey = self.cartKey(cart)
+        stripe = self.stripeFor(cartKey)
+        with stripe.lock:
+            holds = stripe.holds.pop(cartKey, {})
+        held = {product: quantity for product, quantity, _ in holds.values()}
+        missing = {product: quantity - held.get(product, 0) for product, quantity in items.items() if quantity > held.get(product, 0)}
+        if missing and not self.takeStock(missing):
+            with stripe.lock:
+                stripe.holds.setdefault(cartKey, {}).update(holds)
+            return False
+        # reserved units the cart no longer wants go back on the shelf
+        self.returnStock({product: quantity - items.get(product, 0) for product, quantity in held.items()})
+        return True
+
+    def expireStripe(self, stripe, now):
+        expired = {}
+        with stripe.lock:
+            while stripe.expiry and stripe.expiry[0][0] <= now:
+                deadline, cartKey, productId = heapq.heappop(stripe.expiry)
+                holds = stripe.holds.get(cartKey)
+                # entries are dropped lazily if the hold was extended, released or checked out
+                if holds is None or productId not in holds or holds[productId][2] != deadline:
+                    continue
+                product, quantity, _ = holds.pop(productId)
+                if not holds:
+                    del stripe.holds[cartKey]
+                expired[product] = expired.get(product, 0) + quantity
+        self.returnStock(expired)
+
+    def expire(self, now=None):
+        now = time.monotonic() if now is None else now
+        for stripe in self.stripes:
+            self.expireStripe(stripe, now)
+
+    def run(self, interval):
+        while not self.stopped.wait(interval):
+            self.expire()
+
+    def start(self, interval=1.0):
+        if self.thread is None:
+            self.stopped.clear()
+            self.thread = Thread(target=self.run, args=(interval,), daemon=True)
+            self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
 # Cart
 class Cart:
     def __init__(self, customer):
@@ -117,7 +559,7 @@ class Cart:
         self.items = {}    # product -> quantity
 
     def addProduct(self, product, quantity):
-        if product.removeStock(quantity):
+        if ReservationManager().reserve(self, product, quantity):
             self.items[product] = self.items.get(product, 0) + quantity
         else:
             print("Not enough stock!")
@@ -125,6 +567,7 @@ class Cart:
     def removeStock(self, product):
         if product in self.items:
             self.items[product] -= 1
+            ReservationManager().release(self, product, 1)
             if self.items[product] == 0:
                 del self.items[product]
 
@@ -144,6 +587,14 @@ class PaymentGateway(ABC):
     def pay(self, customer, amount):
         pass
 
+    def payBatch(self, requests):
+        # requests is a list of (idempotencyKey, customer, amount); gateways with a bulk API override this
+        return [self.pay(customer, amount) for _, customer, amount in requests]
+
+    def refund(self, customer, amount):
+        # refund implementation
+        return True
+
 class CreditCardPayment(PaymentGateway):
     def pay(self, customer, amount):
         # payment implementation
@@ -154,6 +605,133 @@ class DebitCardPayment(PaymentGateway):
         # payment implementation
         return True
     
+class FakePaymentGateway(PaymentGateway):
+    # local stand-in for a remote gateway: one round trip per batch, random declines and outages
+    def __init__(self, latency=0.05, failureRate=0.0, errorRate=0.0):
+        self.latency = latency
+        self.failureRate = failureRate    # chance a single payment is declined
+        self.errorRate = errorRate    # chance a whole batch fails and must be retried
+        self.processed = {}    # idempotencyKey -> result, so retries never charge twice
+        self.charges = 0
+        self.refunds = 0
+        self.lock = Lock()
+
+    def pay(self, customer, amount):
+        return self.payBatch([(None, customer, amount)])[0]
+
+    def refund(self, customer, amount):
+        with self.lock:
+            self.refunds += 1
+        return True
+
+    def payBatch(self, requests):
+        time.sleep(self.latency)
+        if random.random() < self.errorRate:
+            raise ConnectionError("payment gateway unavailable")
+        res = []
+        with self.lock:
+            for key, customer, amount in requests:
+                if key is not None and key in self.processed:
+                    res.append(self.processed[key])
+                    continue
+                result = random.random() >= self.failureRate
+                if result:
+                    self.charges += 1
+                if key is not None:
+                    self.processed[key] = result
+                res.append(result)
+        return res
+
+class PaymentRequest:
+    def __init__(self, idempotencyKey, customer, amount, callback):
+        self.idempotencyKey = idempotencyKey
+        self.customer = customer
+        self.amount = amount
+        self.callback = callback    # called with True (paid) or False (declined or out of retries)
+        self.attempts = 0
+
+class PaymentPipeline:
+    BATCH_SIZE = 64
+    BATCH_WINDOW = 0.005    # seconds a worker waits to fill a batch
+    MAX_RETRIES = 3
+    RETRY_BACKOFF = 0.05
+    IDLE_TIMEOUT = 1.0    # seconds a worker waits for work before exiting
+
+    def __init__(self):
+        self.queues = {}    # id(gateway) -> Queue of PaymentRequest; an entry lives only while its worker runs
+        self.lock = Lock()
+
+    def submit(self, gateway, request):
+        # the put happens under self.lock, so an idle worker cannot exit between lookup and put
+        with self.lock:
+            queue = self.queues.get(id(gateway))
+            if queue is None:
+                queue = Queue()
+                self.queues[id(gateway)] = queue
+                Thread(target=self.run, args=(gateway, queue), daemon=True).start()
+            queue.put(request)
+
+    def getWorkerCount(self):
+        with self.lock:
+            return len(self.queues)
+
+    def nextBatch(self, gateway, queue):
+        # returns None once the worker has been idle for IDLE_TIMEOUT and has deregistered its queue
+        while True:
+            try:
+                batch = [queue.get(timeout=self.IDLE_TIMEOUT)]
+                break
+            except Empty:
+                with self.lock:
+                    if queue.empty():
+                        del self.queues[id(gateway)]
+                        return None
+        deadline = time.monotonic() + self.BATCH_WINDOW
+        while len(batch) < self.BATCH_SIZE:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(queue.get(timeout=remaining))
+            except Empty:
+                break
+        return batch
+
+    def run(self, gateway, queue):
+        while True:
+            batch = self.nextBatch(gateway, queue)
+            if batch is None:
+                return
+            try:
+                results = gateway.payBatch([(r.idempotencyKey, r.customer, r.amount) for r in batch])
+            except Exception:
+                retries = {}    # attempts -> requests, one timer per backoff delay
+                for request in batch:
+                    request.attempts += 1
+                    if request.attempts > self.MAX_RETRIES:
+                        self.settle(request, False)
+                    else:
+                        retries.setdefault(request.attempts, []).append(request)
+                for attempts, requests in retries.items():
+                    # same idempotency key, so a batch that reached the gateway is not charged twice
+                    timer = Timer(self.RETRY_BACKOFF * (2 ** (attempts - 1)), self.retry, args=(gateway, requests))
+                    timer.daemon = True
+                    timer.start()
+                continue
+            for request, result in zip(batch, results):
+                self.settle(request, bool(result))
+
+    def settle(self, request, paid):
+        # a failing callback must not kill the worker, or its queue would never drain again
+        try:
+            request.callback(paid)
+        except Exception as e:
+            print(f"Payment callback for {request.idempotencyKey} failed: {e!r}")
+
+    def retry(self, gateway, requests):
+        for request in requests:
+            self.submit(gateway, request)
+
 # Singleton Payment Service
 class PaymentService:
     _instance = None
@@ -167,20 +745,337 @@ class PaymentService:
     
     def makePayment(self, paymentMethod, customer, amount):
         return paymentMethod.pay(customer, amount)
+
+    def refundPayment(self, paymentMethod, customer, amount):
+        return paymentMethod.refund(customer, amount)
     
 # Order
 class Order:
-    def __init__(self, id, customer, items, amount, status=OrderStatus.PENDING):
+    def __init__(self, id, customer, items, amount, status=OrderStatus.PENDING, eventBus=None):
         self.id = id
         self.customer = customer
         self.items = items
         self.amount = amount
-        self.address = address
+        self.address = customer.getAddress()
         self.status = status
         self.time = datetime.now()
+        self.settled = Event()    # set once payment has succeeded or failed
+        self.eventBus = eventBus
+        self.lock = Lock()    # guards status when there is no event bus
+        if eventBus is not None:
+            eventBus.publish(self, None, status)
 
-    def updateStatus(self, status):
-        self.status = status
+    def getId(self):
+        return self.id
+
+    def getStatus(self):
+        return self.status
+
+    def updateStatus(self, status, expected=None):
+        # with expected, only moves the order if it is still in that status; returns whether it moved
+        if self.eventBus is not None:
+            return self.eventBus.transition(self, status, expected)
+        with self.lock:
+            if expected is not None and self.status != expected:
+                return False
+            self.status = status
+        return True
+
+    def waitForPayment(self, timeout=None):
+        return self.settled.wait(timeout)
+
+# Order Events
+class OrderEvent:
+    def __init__(self, seq, orderId, oldStatus, newStatus, timestamp):
+        self.seq = seq
+        self.orderId = orderId
+        self.oldStatus = oldStatus
+        self.newStatus = newStatus
+        self.timestamp = timestamp
+
+    def toDict(self):
+        return {
+            "seq": self.seq,
+            "orderId": self.orderId,
+            "oldStatus": self.oldStatus.name if self.oldStatus else None,
+            "newStatus": self.newStatus.name,
+            "timestamp": self.timestamp,
+        }
+
+class OrderEventBus:
+    CAPACITY = 1 << 16    # events retained for subscribers to catch up on
+
+    def __init__(self, capacity=None):
+        self.log = deque(maxlen=capacity or self.CAPACITY)    # OrderEvent, consecutive seqs
+        self.nextSeq = 1
+        self.cursors = {}    # subscriber name -> next seq to deliver, for resuming
+        self.waiters = 0    # pollers blocked in read; publishers only notify when there are some
+        self.cond = Condition()
+
+    def publish(self, order, oldStatus, newStatus):
+        with self.cond:
+            self.append(order.getId(), oldStatus, newStatus)
+
+    def transition(self, order, status, expected=None):
+        # swaps the status and logs it under one lock, so concurrent updates to an order log in order
+        with self.cond:
+            oldStatus = order.status
+            if expected is not None and oldStatus != expected:
+                return False
+            order.status = status
+            self.append(order.getId(), oldStatus, status)
+        return True
+
+    def append(self, orderId, oldStatus, newStatus):
+        # caller must hold self.cond
+        self.log.append(OrderEvent(self.nextSeq, orderId, oldStatus, newStatus, time.time()))
+        self.nextSeq += 1
+        if self.waiters:
+            self.cond.notify_all()
+
+    def subscribe(self, name, fromSeq=None):
+        # resumes from the subscriber's committed cursor unless fromSeq is given
+        with self.cond:
+            if fromSeq is None:
+                fromSeq = self.cursors.get(name, self.nextSeq)
+            self.cursors[name] = fromSeq
+        return OrderSubscription(self, name, fromSeq)
+
+    def read(self, cursor, maxBatch, timeout):
+        # returns (events, nextCursor, missed); missed counts events that aged out before being read
+        with self.cond:
+            if cursor >= self.nextSeq and timeout:
+                self.waiters += 1
+                try:
+                    self.cond.wait_for(lambda: cursor < self.nextSeq, timeout)
+                finally:
+                    self.waiters -= 1
+            if not self.log or cursor >= self.nextSeq:
+                return [], cursor, 0
+            oldest = self.log[0].seq
+            missed = max(0, oldest - cursor)
+            start = max(cursor, oldest)
+            events = list(islice(self.log, start - oldest, start - oldest + maxBatch))
+            return events, start + len(events), missed
+
+    def commit(self, name, cursor):
+        with self.cond:
+            self.cursors[name] = cursor
+
+    def lag(self, name):
+        with self.cond:
+            return self.nextSeq - self.cursors.get(name, self.nextSeq)
+
+class OrderSubscription:
+    def __init__(self, bus, name, cursor):
+        self.bus = bus
+        self.name = name
+        self.cursor = cursor
+        self.missed = 0
+
+    def poll(self, maxBatch=1000, timeout=None):
+        # pull-based, so a slow consumer only falls behind; it never blocks placeOrder
+        events, self.cursor, missed = self.bus.read(self.cursor, maxBatch, timeout)
+        self.missed += missed
+        return events
+
+    def commit(self):
+        self.bus.commit(self.name, self.cursor)
+
+class OrderEventFileSink:
+    # appends events as JSON lines, committing its cursor after each flushed batch
+    def __init__(self, bus, path, name="file-sink", maxBatch=10000, interval=0.1):
+        self.subscription = bus.subscribe(name)
+        self.path = path
+        self.maxBatch = maxBatch
+        self.interval = interval
+        self.stopped = Event()
+        self.thread = None
+
+    def drain(self, f, timeout):
+        events = self.subscription.poll(self.maxBatch, timeout)
+        if events:
+            f.write("".join(json.dumps(event.toDict()) + "\n" for event in events))
+            f.flush()
+            self.subscription.commit()
+        return len(events)
+
+    def run(self):
+        with open(self.path, "a") as f:
+            while not self.stopped.is_set():
+                self.drain(f, self.interval)
+            while self.drain(f, 0):
+                pass
+
+    def start(self):
+        if self.thread is None:
+            self.thread = Thread(target=self.run, daemon=True)
+            self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+# Order Storage
+class OrderIdAllocator:
+    BLOCK_SIZE = 1024
+
+    def __init__(self, start=1):
+        self.nextBlock = start
+        self.lock = Lock()
+        self.local = local()    # per-thread [next, end) of the block it owns
+
+    def next(self):
+        # the shared lock is only taken once every BLOCK_SIZE ids per thread
+        block = getattr(self.local, "block", None)
+        if block is None or block[0] >= block[1]:
+            with self.lock:
+                start = self.nextBlock
+                self.nextBlock += self.BLOCK_SIZE
+            block = self.local.block = [start, start + self.BLOCK_SIZE]
+        orderId = block[0]
+        block[0] += 1
+        return orderId
+
+class OrderShard:
+    def __init__(self):
+        self.orders = {}    # orderId -> Order
+        self.lock = Lock()
+
+class OrderStore:
+    def __init__(self, numShards=64):
+        self.shards = [OrderShard() for _ in range(numShards)]
+
+    def shardFor(self, orderId):
+        return self.shards[hash(orderId) % len(self.shards)]
+
+    def put(self, order):
+        shard = self.shardFor(order.getId())
+        with shard.lock:
+            shard.orders[order.getId()] = order
+
+    def get(self, orderId):
+        shard = self.shardFor(orderId)
+        with shard.lock:
+            return shard.orders.get(orderId)
+
+    def getMany(self, orderIds):
+        # groups ids by shard so each shard lock is taken once; missing ids are skipped
+        byShard = {}
+        for orderId in orderIds:
+            byShard.setdefault(hash(orderId) % len(self.shards), []).append(orderId)
+        res = {}
+        for shardIndex, shardIds in byShard.items():
+            shard = self.shards[shardIndex]
+            with shard.lock:
+                for orderId in shardIds:
+                    if orderId in shard.orders:
+                        res[orderId] = shard.orders[orderId]
+        return res
+
+    def values(self):
+        res = []
+        for shard in self.shards:
+            with shard.lock:
+                res.extend(shard.orders.values())
+        return res
+
+    def __len__(self):
+        return sum(len(shard.orders) for shard in self.shards)
+
+# Order History
+class CustomerHistory:
+    def __init__(self):
+        self.hot = []    # most recent entries, oldest first
+        self.segments = []    # spilled pages, oldest first: (offset, length, oldestKey)
+        self.lock = Lock()
+
+class OrderHistoryStore:
+    HOT_ENTRIES = 50    # entries per customer kept in memory
+    SPILL_BATCH = 50    # entries written per on-disk segment
+
+    def __init__(self):
+        self.customers = {}    # customerId -> CustomerHistory
+        self.spillFile = None
+        self.spillLock = Lock()
+        self.lock = Lock()
+
+    def enableSpill(self, path):
+        # older entries are appended to path and read back only when paged to
+        with self.spillLock:
+            self.spillFile = open(path, "a+b")
+
+    @staticmethod
+    def encode(order):
+        # (time, orderId, amount, ((productId, quantity, unitPrice), ...)) instead of the Order and its cart copy
+        items = tuple((product.getId(), quantity, product.getPrice()) for product, quantity in order.items.items())
+        return (order.time.timestamp(), order.getId(), order.amount, items)
+
+    def historyFor(self, customerId):
+        history = self.customers.get(customerId)
+        if history is None:
+            with self.lock:
+                history = self.customers.setdefault(customerId, CustomerHistory())
+        return history
+
+    def add(self, customerId, order):
+        history = self.historyFor(customerId)
+        entry = self.encode(order)
+        with history.lock:
+            if history.hot and entry[:2] < history.hot[-1][:2]:
+                bisect.insort(history.hot, entry, key=lambda e: e[:2])
+            else:
+                history.hot.append(entry)
+            if self.spillFile is not None and len(history.hot) >= self.HOT_ENTRIES + self.SPILL_BATCH:
+                self.spill(history)
+
+    def spill(self, history):
+        # caller must hold history.lock
+        batch = history.hot[:self.SPILL_BATCH]
+        data = pickle.dumps(batch, protocol=pickle.HIGHEST_PROTOCOL)
+        with self.spillLock:
+            self.spillFile.seek(0, os.SEEK_END)
+            offset = self.spillFile.tell()
+            self.spillFile.write(data)
+            self.spillFile.flush()
+        history.segments.append((offset, len(data), batch[0][:2]))
+        del history.hot[:self.SPILL_BATCH]
+
+    def readSegment(self, offset, length):
+        with self.spillLock:
+            self.spillFile.seek(offset)
+            return pickle.loads(self.spillFile.read(length))
+
+    def page(self, customerId, limit=20, cursor=None):
+        # newest first; cursor is the (time, orderId) of the last entry of the previous page.
+        # Returns (entries, nextCursor), nextCursor is None on the last page.
+        history = self.customers.get(customerId)
+        if history is None:
+            return [], None
+        with history.lock:
+            hot = list(history.hot)
+            segments = list(history.segments)
+        res = []
+        for entry in reversed(hot):
+            if cursor is None or entry[:2] < cursor:
+                res.append(entry)
+                if len(res) > limit:
+                    break
+        for offset, length, oldestKey in reversed(segments):
+            if len(res) > limit:
+                break
+            if cursor is not None and oldestKey >= cursor:
+                continue
+            for entry in reversed(self.readSegment(offset, length)):
+                if cursor is None or entry[:2] < cursor:
+                    res.append(entry)
+                    if len(res) > limit:
+                        break
+        if len(res) > limit:
+            return res[:limit], res[limit - 1][:2]
+        return res, None
 
 class OrderManager:
     _instance = None
@@ -190,36 +1085,58 @@ class OrderManager:
         with cls._lock:
             if not cls._instance:
                 cls._instance = super().__new__(cls)
+                cls._instance.setup()
         return cls._instance
     
-    def __init__(self):
-        self.orders = {}    # orderId -> Order
-        self.orderId = 1
-        self.lock = Lock()
+    def setup(self):
+        # runs once; __init__ would reset the singleton's orders on every OrderManager() call
+        self.orders = OrderStore()
+        self.orderIds = OrderIdAllocator()
+        self.history = OrderHistoryStore()
+        self.events = OrderEventBus()
         self.paymentService = PaymentService()
+        self.paymentPipeline = PaymentPipeline()
 
     def placeOrder(self, customer, paymentMethod):
-        with self.lock:
-            items = customer.getCartItems()
-            totalPrice = customer.getCartTotal()
-            orderId = self.orderId
-            self.orderId += 1
-        order = Order(orderId, customer, items, totalPrice)
-        self.orders[orderId] = order
+        items = customer.getCartItems()
+        totalPrice = customer.getCartTotal()
+        orderId = self.orderIds.next()
+        order = Order(orderId, customer, items, totalPrice, eventBus=self.events)
+        self.orders.put(order)
         customer.addToOrderHistory(order)
-        if self.paymentService.makePayment(paymentMethod, customer, totalPrice):
-            order.updateStatus(OrderStatus.IN_PROGRESS)
-        else:
+        reservations = ReservationManager()
+        if not reservations.checkout(customer.getCart(), items):
             order.updateStatus(OrderStatus.FAILED)
+            order.settled.set()
+        else:
+            # the order stays PENDING until the payment pipeline calls back
+            def onPayment(paid):
+                # only a PENDING order moves; one cancelled meanwhile gets its stock back and, if paid, a refund
+                if paid:
+                    if not order.updateStatus(OrderStatus.IN_PROGRESS, OrderStatus.PENDING):
+                        reservations.returnStock(items)
+                        self.paymentService.refundPayment(paymentMethod, customer, totalPrice)
+                else:
+                    reservations.returnStock(items)
+                    order.updateStatus(OrderStatus.FAILED, OrderStatus.PENDING)
+                order.settled.set()
+            request = PaymentRequest(f"order-{orderId}", customer, totalPrice, onPayment)
+            self.paymentPipeline.submit(paymentMethod, request)
         customer.clearCart()
         return order
     
+    def getOrder(self, orderId):
+        return self.orders.get(orderId)
+
+    def getOrders(self, orderIds):
+        return self.orders.getMany(orderIds)
+
     def cancelOrder(self, orderId):
-        with self.lock:
-            order = self.orders[orderId]
-            order.updateStatus(OrderStatus.CANCELLED)
-            return True
-        return False
+        order = self.orders.get(orderId)
+        if order is None:
+            return False
+        order.updateStatus(OrderStatus.CANCELLED)
+        return True
     
 # Amazon
 class Amazon:
@@ -254,8 +1171,147 @@ class Amazon:
         self.inventory.addProduct(product)
         return True
     
+    def searchProducts(self, query, limit=10, minPrice=None, maxPrice=None, inStockOnly=False):
+        return self.inventory.search(query, limit, minPrice, maxPrice, inStockOnly)
+
+    def autocomplete(self, prefix, limit=10):
+        return self.inventory.autocomplete(prefix, limit)
+
     def placeOrder(self, customer, paymentMethod):
         return self.orderManager.placeOrder(customer, paymentMethod)
     
     def cancelOrder(self, orderId):
-        return self.orderManager.cancelOrder(orderId)
\ No newline at end of file
+        return self.orderManager.cancelOrder(orderId)
+
+# Benchmark
+class TimedLock:
+    def __init__(self):
+        self.lock = Lock()
+        self.statsLock = Lock()
+        self.waitTime = 0.0
+        self.acquisitions = 0
+
+    def acquire(self, blocking=True, timeout=-1):
+        start = time.perf_counter()
+        acquired = self.lock.acquire(blocking, timeout)
+        waited = time.perf_counter() - start
+        with self.statsLock:
+            self.waitTime += waited
+            self.acquisitions += 1
+        return acquired
+
+    def release(self):
+        self.lock.release()
+
+    def __enter__(self):
+        return self.acquire()
+
+    def __exit__(self, *args):
+        self.release()
+
+class FlashSaleBenchmark:
+    def __init__(self, customers=2000, hotProducts=3, stockPerProduct=500, maxQuantity=2,
+                 paymentLatency=0.05, paymentFailureRate=0.0, seed=None):
+        self.customers = customers    # one thread per customer
+        self.hotProducts = hotProducts
+        self.stockPerProduct = stockPerProduct
+        self.maxQuantity = maxQuantity
+        self.paymentLatency = paymentLatency
+        self.paymentFailureRate = paymentFailureRate
+        self.seed = seed
+        self.checkoutLatencies = []    # placeOrder call, seconds
+        self.settleLatencies = []    # placeOrder until payment settled, seconds
+        self.orders = []
+        self.statsLock = Lock()
+
+    def build(self):
+        self.amazon = Amazon()
+        self.amazon.registerSeller("flash-seller", "Flash Seller")
+        self.products = []
+        for i in range(self.hotProducts):
+            productId = f"flash-{i}"
+            self.amazon.addProductToInventory("flash-seller", productId, f"Flash deal {i}", 100, self.stockPerProduct)
+            product = self.amazon.inventory.getProductById(productId)
+            product.lock = TimedLock()
+            self.products.append(product)
+        self.amazon.inventory.lock = TimedLock()
+        orderManager = self.amazon.orderManager
+        orderManager.orderIds.lock = TimedLock()
+        for shard in orderManager.orders.shards:
+            shard.lock = TimedLock()
+        for i in range(self.customers):
+            self.amazon.registerCustomer(f"flash-customer-{i}", f"Customer {i}", "Address", "Contact")
+        self.gateway = FakePaymentGateway(self.paymentLatency, self.paymentFailureRate)
+
+    def worker(self, i, barrier):
+        rng = random.Random(None if self.seed is None else self.seed + i)
+        customer = self.amazon.customers[f"flash-customer-{i}"]
+        product = rng.choice(self.products)
+        quantity = rng.randint(1, self.maxQuantity)
+        barrier.wait()
+        customer.getCart().addProduct(product, quantity)
+        if not customer.getCartItems():
+            return
+        start = time.perf_counter()
+        order = self.amazon.placeOrder(customer, self.gateway)
+        placed = time.perf_counter()
+        order.waitForPayment()
+        settled = time.perf_counter()
+        with self.statsLock:
+            self.checkoutLatencies.append(placed - start)
+            self.settleLatencies.append(settled - start)
+            self.orders.append(order)
+
+    def run(self):
+        self.build()
+        barrier = Barrier(self.customers)
+        workers = [Thread(target=self.worker, args=(i, barrier)) for i in range(self.customers)]
+        start = time.perf_counter()
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        return self.report(time.perf_counter() - start)
+
+    def percentile(self, values, pct):
+        values = sorted(values)
+        return values[min(len(values) - 1, int(len(values) * pct / 100))] if values else 0.0
+
+    def lockStats(self, locks):
+        waitTime = sum(lock.waitTime for lock in locks)
+        acquisitions = sum(lock.acquisitions for lock in locks)
+        return {"waitTime": waitTime, "waitPerAcquisition": waitTime / acquisitions if acquisitions else 0.0}
+
+    def oversells(self):
+        # stock never goes negative, and paid orders never exceed what was on the shelf
+        res = []
+        sold = {product: 0 for product in self.products}
+        for order in self.orders:
+            if order.getStatus() == OrderStatus.IN_PROGRESS:
+                for product, quantity in order.items.items():
+                    sold[product] += quantity
+        for product in self.products:
+            if product.getStock() < 0:
+                res.append(f"{product.getId()} stock is {product.getStock()}")
+            if sold[product] > self.stockPerProduct:
+                res.append(f"{product.getId()} sold {sold[product]} of {self.stockPerProduct}")
+            if sold[product] + product.getStock() != self.stockPerProduct:
+                res.append(f"{product.getId()} sold {sold[product]} + stock {product.getStock()} != {self.stockPerProduct}")
+        return res
+
+    def report(self, elapsed):
+        paid = sum(1 for order in self.orders if order.getStatus() == OrderStatus.IN_PROGRESS)
+        orderManager = self.amazon.orderManager
+        return {
+            "elapsed": elapsed,
+            "orders": len(self.orders),
+            "paidOrders": paid,
+            "ordersPerSecond": len(self.orders) / elapsed,
+            "checkoutP50": self.percentile(self.checkoutLatencies, 50),
+            "checkoutP99": self.percentile(self.checkoutLatencies, 99),
+            "settleP99": self.percentile(self.settleLatencies, 99),
+            "productLocks": self.lockStats([product.lock for product in self.products]),
+            "inventoryLock": self.lockStats([self.amazon.inventory.lock]),
+            "orderManagerLocks": self.lockStats([orderManager.orderIds.lock] + [shard.lock for shard in orderManager.orders.shards]),
+            "oversells": self.oversells(),
+        }
@@ -1,3 +1,15 @@
+from datetime import datetime, timedelta
+from threading import Lock, Thread, Event
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
+from array import array
+from collections import deque
+from itertools import islice
+import heapq
+import bisect
+import time
+import random
+import asyncio
+
 # Enums
 class SeatStatus:
     AVAILABLE = 1
@@ -19,6 +31,11 @@ class BookingStatus:
     CONFIRMED = 2
     CANCELLED = 3
 
+class SeatPreference:
+    FRONT = 1
+    MIDDLE = 2
+    BACK = 3
+
 DEFAULT_PRICING = {
     SeatType.NORMAL: 10,
     SeatType.PREMIUM: 15,
@@ -63,14 +80,22 @@ class Theater:
     
 # Seat
 class Seat:
-    def __init__(self, id, seatType, status):
+    def __init__(self, id, seatType, status, row=None, col=None):
         self.id = id
         self.seatType = seatType
         self.status = status
+        self.row = row
+        self.col = col
         self.lastChanged = datetime.now()
 
     def getId(self):
         return self.id
+
+    def getRow(self):
+        return self.row
+
+    def getCol(self):
+        return self.col
     
     def getSeatType(self):
         return self.seatType
@@ -81,59 +106,247 @@ class Seat:
     def getLastChanged(self):
         return self.lastChanged
     
-    def updateStatus(self, seatStatus):
+    def updateStatus(self, seatStatus, changedAt=None):
         self.status = seatStatus
-        self.lastChanged = datetime.now()
+        self.lastChanged = changedAt or datetime.now()
     
+# Row Index
+class RowIndex:
+    def __init__(self, cells):
+        # cells: iterable of (seatId, row, col, seatType, isAvailable)
+        self.rows = {}    # row -> {col: (seatId, seatType)}
+        available = set()
+        for seatId, row, col, seatType, isAvailable in cells:
+            if row is not None:
+                self.rows.setdefault(row, {})[col] = (seatId, seatType)
+                if isAvailable:
+                    available.add((row, col))
+        self.rowOrder = sorted(self.rows)
+        self.rowCenters = {row: (min(cols) + max(cols)) / 2 for row, cols in self.rows.items()}
+        self.runStarts = {row: [] for row in self.rows}    # row -> sorted start cols of free runs
+        self.runs = {row: {} for row in self.rows}    # row -> {start: (end, seatType)}
+        for row, cols in self.rows.items():
+            start = prev = None
+            for col in sorted(cols):
+                seatType = cols[col][1]
+                if (row, col) not in available:
+                    continue
+                if start is not None and col == prev + 1 and cols[prev][1] == seatType:
+                    prev = col
+                    continue
+                if start is not None:
+                    self.addRun(row, start, prev, cols[start][1])
+                start = prev = col
+            if start is not None:
+                self.addRun(row, start, prev, cols[start][1])
+
+    @classmethod
+    def fromSeats(cls, seats):
+        return cls((seat.getId(), seat.getRow(), seat.getCol(), seat.getSeatType(), seat.getStatus() == SeatStatus.AVAILABLE)
+                   for seat in seats.values())
+
+    def addRun(self, row, start, end, seatType):
+        bisect.insort(self.runStarts[row], start)
+        self.runs[row][start] = (end, seatType)
+
+    def removeRun(self, row, start):
+        starts = self.runStarts[row]
+        del starts[bisect.bisect_left(starts, start)]
+        return self.runs[row].pop(start)
+
+    def findRun(self, row, col):
+        starts = self.runStarts[row]
+        idx = bisect.bisect_right(starts, col) - 1
+        if idx >= 0 and self.runs[row][starts[idx]][0] >= col:
+            return starts[idx]
+        return None
+
+    def occupy(self, row, col):
+        if row is None:
+            return
+        start = self.findRun(row, col)
+        if start is None:
+            return
+        end, seatType = self.removeRun(row, start)
+        if start < col:
+            self.addRun(row, start, col - 1, seatType)
+        if col < end:
+            self.addRun(row, col + 1, end, seatType)
+
+    def free(self, row, col):
+        if row is None or self.findRun(row, col) is not None:
+            return
+        seatType = self.rows[row][col][1]
+        start = end = col
+        left = self.findRun(row, col - 1)
+        if left is not None and self.runs[row][left][1] == seatType:
+            start = left
+            self.removeRun(row, left)
+        if col + 1 in self.runs[row] and self.runs[row][col + 1][1] == seatType:
+            end = self.removeRun(row, col + 1)[0]
+        self.addRun(row, start, end, seatType)
+
+    def best(self, count, seatType, preference):
+        if not self.rowOrder:
+            return None
+        last = len(self.rowOrder) - 1
+        preferredRow = {SeatPreference.FRONT: 0, SeatPreference.BACK: last}.get(preference, last / 2)
+        bestScore, bestBlock = None, None
+        for rowPos, row in enumerate(self.rowOrder):
+            center = self.rowCenters[row]
+            for start, (end, runType) in self.runs[row].items():
+                if runType != seatType or end - start + 1 < count:
+                    continue
+                # the block inside this run whose middle is closest to the row centre
+                blockStart = min(max(round(center - (count - 1) / 2), start), end - count + 1)
+                score = abs(blockStart + (count - 1) / 2 - center) + abs(rowPos - preferredRow)
+                if bestScore is None or score < bestScore:
+                    bestScore, bestBlock = score, (row, blockStart)
+        if bestBlock is None:
+            return None
+        row, blockStart = bestBlock
+        return [self.rows[row][col][0] for col in range(blockStart, blockStart + count)]
+
 # SeatManager
 class SeatManager:
     HOLD_TIMEOUT = timedelta(minutes=5)
+    CHANGE_LOG_SIZE = 1024
 
     def __init__(self, seats):
         self.seats = seats    # seatId -> Seat
+        self.holdExpiry = []    # min-heap of (deadline, seatId, heldAt)
+        self.rowIndex = RowIndex.fromSeats(seats)
+        self.version = 0
+        self.changeLog = deque(maxlen=self.CHANGE_LOG_SIZE)    # (version, seatId, SeatStatus)
         self.lock = Lock()
-                
+
+    def changeStatus(self, seat, seatStatus, changedAt=None):
+        # caller must hold self.lock; keeps the row index and change log in step with seat status
+        wasAvailable = seat.getStatus() == SeatStatus.AVAILABLE
+        seat.updateStatus(seatStatus, changedAt)
+        self.version += 1
+        self.changeLog.append((self.version, seat.getId(), seatStatus))
+        if wasAvailable and seatStatus != SeatStatus.AVAILABLE:
+            self.rowIndex.occupy(seat.getRow(), seat.getCol())
+        elif not wasAvailable and seatStatus == SeatStatus.AVAILABLE:
+            self.rowIndex.free(seat.getRow(), seat.getCol())
+
+    def trackHold(self, seat):
+        heapq.heappush(self.holdExpiry, (seat.getLastChanged() + self.HOLD_TIMEOUT, seat.getId(), seat.getLastChanged()))
+
+    def expireHolds(self, curr):
+        # caller must hold self.lock; entries are dropped lazily if the seat was booked or re-held since
+        while self.holdExpiry and self.holdExpiry[0][0] < curr:
+            _, seatId, heldAt = heapq.heappop(self.holdExpiry)
+            seat = self.seats[seatId]
+            if seat.getStatus() == SeatStatus.HELD and seat.getLastChanged() == heldAt:
+                self.changeStatus(seat, SeatStatus.AVAILABLE)
+
+    def nextExpiry(self):
+        with self.lock:
+            return self.holdExpiry[0][0] if self.holdExpiry else None
+
     def releaseExpiredHolds(self):
         with self.lock:
-            curr = datetime.now()
-            for seat in self.seats.values():
-                if curr - seat.getLastChanged() > self.HOLD_TIMEOUT:
-                    seat.updateStatus(SeatStatus.AVAILABLE)
+            self.expireHolds(datetime.now())
 
     def view(self):
         with self.lock:
-            self.releaseExpiredHolds()
+            self.expireHolds(datetime.now())
             return {seatId: seat.getStatus() for seatId, seat in self.seats.items()}
+
+    def getVersion(self):
+        with self.lock:
+            return self.version
+
+    def changesSince(self, version):
+        # returns (currentVersion, {seatId: status}, isSnapshot); falls back to a full
+        # snapshot when version has aged out of the change log
+        with self.lock:
+            self.expireHolds(datetime.now())
+            if version == self.version:
+                return self.version, {}, False
+            if 0 <= version < self.version and self.changeLog and self.changeLog[0][0] <= version + 1:
+                changes = {}
+                for _, seatId, seatStatus in islice(self.changeLog, version + 1 - self.changeLog[0][0], None):
+                    changes[seatId] = seatStatus
+                return self.version, changes, False
+            return self.version, {seatId: seat.getStatus() for seatId, seat in self.seats.items()}, True
         
     def hold(self, seatIds):
+        return self.holdSeats(seatIds) is not None
+
+    def holdSeats(self, seatIds):
+        # returns the hold timestamp, used as a token by confirmHold/releaseHold
+        with self.lock:
+            curr = datetime.now()
+            self.expireHolds(curr)
+            return self.holdAvailable(seatIds, curr)
+
+    def holdAvailable(self, seatIds, curr):
+        # caller must hold self.lock
+        for seatId in seatIds:
+            if seatId not in self.seats or self.seats[seatId].getStatus() != SeatStatus.AVAILABLE:
+                return None
+        for seatId in seatIds:
+            seat = self.seats[seatId]
+            self.changeStatus(seat, SeatStatus.HELD, curr)
+            self.trackHold(seat)
+        return curr
+
+    def findBestAvailable(self, count, seatType, preference=SeatPreference.MIDDLE):
+        with self.lock:
+            self.expireHolds(datetime.now())
+            return self.rowIndex.best(count, seatType, preference)
+
+    def holdBestAvailable(self, count, seatType, preference=SeatPreference.MIDDLE):
+        # returns (seatIds, heldAt), or (None, None) if no block of count adjacent seats is free
         with self.lock:
-            self.releaseExpiredHolds()
+            curr = datetime.now()
+            self.expireHolds(curr)
+            seatIds = self.rowIndex.best(count, seatType, preference)
+            if seatIds is None:
+                return None, None
+            return seatIds, self.holdAvailable(seatIds, curr)
+
+    def isHeld(self, seatId, heldAt):
+        seat = self.seats.get(seatId)
+        return seat is not None and seat.getStatus() == SeatStatus.HELD and seat.getLastChanged() == heldAt
+
+    def confirmHold(self, seatIds, heldAt):
+        with self.lock:
+            self.expireHolds(datetime.now())
             for seatId in seatIds:
-                if seatId not in self.seats or self.seats[seatId].getStatus() != SeatStatus.AVAILABLE:
+                if not self.isHeld(seatId, heldAt):
                     return False
-            curr = datetime.now()
             for seatId in seatIds:
-                self.seats[seatId].updateStatus(SeatStatus.HELD)
+                self.changeStatus(self.seats[seatId], SeatStatus.BOOKED)
             return True
+
+    def releaseHold(self, seatIds, heldAt):
+        with self.lock:
+            for seatId in seatIds:
+                if self.isHeld(seatId, heldAt):
+                    self.changeStatus(self.seats[seatId], SeatStatus.AVAILABLE)
         
     def book(self, seatIds):
         with self.lock:
-            self.releaseExpiredHolds()
+            self.expireHolds(datetime.now())
             for seatId in seatIds:
                 if seatId not in self.seats or self.seats[seatId].getStatus() != SeatStatus.HELD:
                     return False
             for seatId in seatIds:
-                self.seats[seatId].setStatus(SeatStatus.BOOKED)
+                self.changeStatus(self.seats[seatId], SeatStatus.BOOKED)
             return True
         
     def cancel(self, seatIds):
         with self.lock:
-            self.releaseExpiredHolds()
+            self.expireHolds(datetime.now())
             for seatId in seatIds:
                 if seatId not in self.seats or self.seats[seatId].getStatus() != SeatStatus.BOOKED:
                     return False
             for seatId in seatIds:
-                self.seats[seatId].setStatus(SeatStatus.AVAILABLE)
+                self.changeStatus(self.seats[seatId], SeatStatus.AVAILABLE)
             return True
         
     def calculatePrice(self, seatIds):
@@ -143,13 +356,266 @@ class SeatManager:
             res += DEFAULT_PRICING[seatType]
         return res
     
+# Compact Seat Map
+class CompactSeatMap:
+    HOLD_TIMEOUT = SeatManager.HOLD_TIMEOUT.total_seconds()
+    CHANGE_LOG_SIZE = SeatManager.CHANGE_LOG_SIZE
+
+    def __init__(self, seatIds, seatTypes, rows=None, cols=None, statuses=None):
+        self.seatIds = list(seatIds)    # ordinal -> seatId
+        self.ordinals = {seatId: i for i, seatId in enumerate(self.seatIds)}    # seatId -> ordinal
+        self.seatTypes = array('B', seatTypes)    # ordinal -> SeatType
+        if statuses is not None:
+            self.statuses = array('B', statuses)    # ordinal -> SeatStatus
+        else:
+            self.statuses = array('B', [SeatStatus.AVAILABLE]) * len(self.seatIds)
+        self.heldAt = array('d', [0.0]) * len(self.seatIds)    # ordinal -> hold timestamp
+        self.rows = array('i', [-1]) * len(self.seatIds)    # ordinal -> row, -1 if the seat has no position
+        self.cols = array('i', [-1]) * len(self.seatIds)    # ordinal -> col
+        cells = []
+        if rows is not None:
+            for ordinal, (row, col) in enumerate(zip(rows, cols)):
+                if row is not None:
+                    self.rows[ordinal], self.cols[ordinal] = row, col
+                    cells.append((self.seatIds[ordinal], row, col, self.seatTypes[ordinal],
+                                  self.statuses[ordinal] == SeatStatus.AVAILABLE))
+        self.rowIndex = RowIndex(cells)
+        self.holdExpiry = []    # min-heap of (deadline, ordinal, heldAt)
+        self.version = 0
+        self.changeLog = deque(maxlen=self.CHANGE_LOG_SIZE)    # (version, ordinal, SeatStatus)
+        self.lock = Lock()
+
+    @classmethod
+    def fromSeats(cls, seats):
+        return cls(seats.keys(), [seat.getSeatType() for seat in seats.values()],
+                   [seat.getRow() for seat in seats.values()], [seat.getCol() for seat in seats.values()],
+                   [seat.getStatus() for seat in seats.values()])
+
+    def getOrdinal(self, seatId):
+        return self.ordinals.get(seatId)
+
+    def getStatus(self, ordinal):
+        return self.statuses[ordinal]
+
+    def setStatus(self, ordinal, seatStatus):
+        # caller must hold self.lock; keeps the row index and change log in step with seat status
+        wasAvailable = self.statuses[ordinal] == SeatStatus.AVAILABLE
+        self.statuses[ordinal] = seatStatus
+        self.version += 1
+        self.changeLog.append((self.version, ordinal, seatStatus))
+        row = self.rows[ordinal]
+        if row < 0:
+            return
+        if wasAvailable and seatStatus != SeatStatus.AVAILABLE:
+            self.rowIndex.occupy(row, self.cols[ordinal])
+        elif not wasAvailable and seatStatus == SeatStatus.AVAILABLE:
+            self.rowIndex.free(row, self.cols[ordinal])
+
+    def expireHolds(self, curr):
+        # caller must hold self.lock
+        while self.holdExpiry and self.holdExpiry[0][0] < curr:
+            _, ordinal, heldAt = heapq.heappop(self.holdExpiry)
+            if self.statuses[ordinal] == SeatStatus.HELD and self.heldAt[ordinal] == heldAt:
+                self.setStatus(ordinal, SeatStatus.AVAILABLE)
+
+    def nextExpiry(self):
+        with self.lock:
+            return datetime.fromtimestamp(self.holdExpiry[0][0]) if self.holdExpiry else None
+
+    def releaseExpiredHolds(self):
+        with self.lock:
+            self.expireHolds(time.time())
+
+    def transition(self, ordinals, fromStatus, toStatus):
+        # caller must hold self.lock; returns the transition timestamp or None
+        curr = time.time()
+        self.expireHolds(curr)
+        statuses = self.statuses
+        for ordinal in ordinals:
+            if not 0 <= ordinal < len(statuses) or statuses[ordinal] != fromStatus:
+                return None
+        for ordinal in ordinals:
+            self.setStatus(ordinal, toStatus)
+            if toStatus == SeatStatus.HELD:
+                self.heldAt[ordinal] = curr
+                heapq.heappush(self.holdExpiry, (curr + self.HOLD_TIMEOUT, ordinal, curr))
+        return curr
+
+    def holdOrdinals(self, ordinals):
+        with self.lock:
+            return self.transition(ordinals, SeatStatus.AVAILABLE, SeatStatus.HELD) is not None
+
+    def bookOrdinals(self, ordinals):
+        with self.lock:
+            return self.transition(ordinals, SeatStatus.HELD, SeatStatus.BOOKED) is not None
+
+    def cancelOrdinals(self, ordinals):
+        with self.lock:
+            return self.transition(ordinals, SeatStatus.BOOKED, SeatStatus.AVAILABLE) is not None
+
+    def toOrdinals(self, seatIds):
+        ordinals = []
+        for seatId in seatIds:
+            if seatId not in self.ordinals:
+                return None
+            ordinals.append(self.ordinals[seatId])
+        return ordinals
+
+    def hold(self, seatIds):
+        ordinals = self.toOrdinals(seatIds)
+        return ordinals is not None and self.holdOrdinals(ordinals)
+
+    def book(self, seatIds):
+        ordinals = self.toOrdinals(seatIds)
+        return ordinals is not None and self.bookOrdinals(ordinals)
+
+    def cancel(self, seatIds):
+        ordinals = self.toOrdinals(seatIds)
+        return ordinals is not None and self.cancelOrdinals(ordinals)
+
+    def holdSeats(self, seatIds):
+        ordinals = self.toOrdinals(seatIds)
+        if ordinals is None:
+            return None
+        with self.lock:
+            return self.transition(ordinals, SeatStatus.AVAILABLE, SeatStatus.HELD)
+
+    def findBestAvailable(self, count, seatType, preference=SeatPreference.MIDDLE):
+        with self.lock:
+            self.expireHolds(time.time())
+            return self.rowIndex.best(count, seatType, preference)
+
+    def holdBestAvailable(self, count, seatType, preference=SeatPreference.MIDDLE):
+        # returns (seatIds, heldAt), or (None, None) if no block of count adjacent seats is free
+        with self.lock:
+            self.expireHolds(time.time())
+            seatIds = self.rowIndex.best(count, seatType, preference)
+            if seatIds is None:
+                return None, None
+            return seatIds, self.transition(self.toOrdinals(seatIds), SeatStatus.AVAILABLE, SeatStatus.HELD)
+
+    def isHeld(self, ordinal, heldAt):
+        return self.statuses[ordinal] == SeatStatus.HELD and self.heldAt[ordinal] == heldAt
+
+    def confirmHold(self, seatIds, heldAt):
+        ordinals = self.toOrdinals(seatIds)
+        if ordinals is None:
+            return False
+        with self.lock:
+            self.expireHolds(time.time())
+            for ordinal in ordinals:
+                if not self.isHeld(ordinal, heldAt):
+                    return False
+            for ordinal in ordinals:
+                self.setStatus(ordinal, SeatStatus.BOOKED)
+            return True
+
+    def releaseHold(self, seatIds, heldAt):
+        ordinals = self.toOrdinals(seatIds) or []
+        with self.lock:
+            for ordinal in ordinals:
+                if self.isHeld(ordinal, heldAt):
+                    self.setStatus(ordinal, SeatStatus.AVAILABLE)
+
+    def view(self):
+        # one status byte per seat ordinal
+        with self.lock:
+            self.expireHolds(time.time())
+            return self.statuses.tobytes()
+
+    def viewBySeat(self):
+        # same shape as SeatManager.view
+        with self.lock:
+            self.expireHolds(time.time())
+            return dict(zip(self.seatIds, self.statuses))
+
+    def getVersion(self):
+        with self.lock:
+            return self.version
+
+    def changesSince(self, version):
+        # same contract as SeatManager.changesSince
+        with self.lock:
+            self.expireHolds(time.time())
+            if version == self.version:
+                return self.version, {}, False
+            if 0 <= version < self.version and self.changeLog and self.changeLog[0][0] <= version + 1:
+                changes = {}
+                for _, ordinal, seatStatus in islice(self.changeLog, version + 1 - self.changeLog[0][0], None):
+                    changes[self.seatIds[ordinal]] = seatStatus
+                return self.version, changes, False
+            return self.version, dict(zip(self.seatIds, self.statuses)), True
+
+    def availableBitmap(self):
+        # bit i is set when ordinal i is available
+        with self.lock:
+            self.expireHolds(time.time())
+            res = 0
+            for ordinal, status in enumerate(self.statuses):
+                if status == SeatStatus.AVAILABLE:
+                    res |= 1 << ordinal
+            return res.to_bytes((len(self.statuses) + 7) // 8, 'little')
+
+    def calculatePrice(self, seatIds):
+        res = 0
+        for seatId in seatIds:
+            res += DEFAULT_PRICING[self.seatTypes[self.ordinals[seatId]]]
+        return res
+
+# Hold Reaper
+class HoldReaper:
+    def __init__(self, interval=1.0):
+        self.interval = interval
+        self.seatManagers = []    # list of SeatManager
+        self.lock = Lock()
+        self.stopped = Event()
+        self.thread = None
+
+    def register(self, seatManager):
+        with self.lock:
+            self.seatManagers.append(seatManager)
+
+    def unregister(self, seatManager):
+        with self.lock:
+            if seatManager in self.seatManagers:
+                self.seatManagers.remove(seatManager)
+
+    def reap(self):
+        with self.lock:
+            seatManagers = list(self.seatManagers)
+        curr = datetime.now()
+        for seatManager in seatManagers:
+            deadline = seatManager.nextExpiry()
+            if deadline is not None and deadline < curr:
+                seatManager.releaseExpiredHolds()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.reap()
+
+    def start(self):
+        if self.thread is None:
+            self.stopped.clear()
+            self.thread = Thread(target=self.run, daemon=True)
+            self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
 # Show
 class Show:
-    def __init__(self, id, movie, theater, seatLayout):
+    def __init__(self, id, movie, theater, seatLayout, startTime=None, compact=False):
         self.id = id
         self.movie = movie
         self.theater = theater
-        self.seatManager = SeatManager(seatLayout)
+        self.startTime = startTime
+        if compact:
+            self.seatManager = CompactSeatMap.fromSeats(seatLayout)
+        else:
+            self.seatManager = SeatManager(seatLayout)
 
     def getId(self):
         return self.id
@@ -159,10 +625,101 @@ class Show:
     
     def getTheater(self):
         return self.theater
+
+    def getStartTime(self):
+        return self.startTime
     
     def getSeatManager(self):
         return self.seatManager
 
+# Show Index
+class ShowIndex:
+    def __init__(self):
+        self.byTitle = {}    # normalised title -> set of showIds
+        self.titles = []    # sorted normalised titles, for prefix lookups
+        self.byCity = {}    # normalised city -> set of showIds
+        self.byTheater = {}    # theaterId -> set of showIds
+        self.byTime = []    # sorted list of (startTime, showId)
+
+    @staticmethod
+    def normalise(text):
+        return " ".join(text.lower().split())
+
+    def addTo(self, index, key, showId):
+        if key not in index:
+            index[key] = set()
+        index[key].add(showId)
+
+    def removeFrom(self, index, key, showId):
+        showIds = index.get(key)
+        if showIds is None:
+            return False
+        showIds.discard(showId)
+        if not showIds:
+            del index[key]
+            return True
+        return False
+
+    def add(self, show):
+        showId = show.getId()
+        title = self.normalise(show.getMovie().getTitle())
+        if title not in self.byTitle:
+            bisect.insort(self.titles, title)
+        self.addTo(self.byTitle, title, showId)
+        self.addTo(self.byCity, self.normalise(show.getTheater().getCity()), showId)
+        self.addTo(self.byTheater, show.getTheater().getId(), showId)
+        if show.getStartTime() is not None:
+            bisect.insort(self.byTime, (show.getStartTime(), showId))
+
+    def remove(self, show):
+        showId = show.getId()
+        title = self.normalise(show.getMovie().getTitle())
+        if self.removeFrom(self.byTitle, title, showId):
+            del self.titles[bisect.bisect_left(self.titles, title)]
+        self.removeFrom(self.byCity, self.normalise(show.getTheater().getCity()), showId)
+        self.removeFrom(self.byTheater, show.getTheater().getId(), showId)
+        if show.getStartTime() is not None:
+            idx = bisect.bisect_left(self.byTime, (show.getStartTime(), showId))
+            if idx < len(self.byTime) and self.byTime[idx] == (show.getStartTime(), showId):
+                del self.byTime[idx]
+
+    def matchPrefix(self, prefix):
+        res = set()
+        idx = bisect.bisect_left(self.titles, prefix)
+        while idx < len(self.titles) and self.titles[idx].startswith(prefix):
+            res |= self.byTitle[self.titles[idx]]
+            idx += 1
+        return res
+
+    def matchTime(self, start, end):
+        lo = 0 if start is None else bisect.bisect_left(self.byTime, (start,))
+        hi = len(self.byTime) if end is None else bisect.bisect_left(self.byTime, (end,))
+        res = set()
+        for idx in range(lo, hi):
+            res.add(self.byTime[idx][1])
+        return res
+
+    def query(self, title=None, titlePrefix=None, city=None, theaterId=None, start=None, end=None):
+        # returns the ids of shows matching every given filter; start/end bound the start time as [start, end)
+        candidates = []
+        if title is not None:
+            candidates.append(self.byTitle.get(self.normalise(title), set()))
+        if titlePrefix is not None:
+            candidates.append(self.matchPrefix(self.normalise(titlePrefix)))
+        if city is not None:
+            candidates.append(self.byCity.get(self.normalise(city), set()))
+        if theaterId is not None:
+            candidates.append(self.byTheater.get(theaterId, set()))
+        if start is not None or end is not None:
+            candidates.append(self.matchTime(start, end))
+        if not candidates:
+            return None
+        candidates.sort(key=len)
+        res = set(candidates[0])
+        for showIds in candidates[1:]:
+            res &= showIds
+        return res
+
 # User
 class User:
     def __init__(self, id, name, contact):
@@ -184,13 +741,22 @@ class PaymentGateway:
     def pay(self, user, amount):
         pass
 
+    def refund(self, user, amount):
+        pass
+
 class CreditCardPayment(PaymentGateway):
     def pay(self, user, amount):
         return PaymentStatus.SUCCESS
+
+    def refund(self, user, amount):
+        return PaymentStatus.SUCCESS
     
 class DebitCardPayment(PaymentGateway):
     def pay(self, user, amount):
         return PaymentStatus.SUCCESS
+
+    def refund(self, user, amount):
+        return PaymentStatus.SUCCESS
     
 class PaymentService:
     _instance = None
@@ -204,6 +770,9 @@ class PaymentService:
     
     def makePayment(self, paymentMethod, user, amount):
         return paymentMethod.pay(user, amount)
+
+    def refundPayment(self, paymentMethod, user, amount):
+        return paymentMethod.refund(user, amount)
     
 # Booking
 class Booking:
@@ -213,48 +782,276 @@ class Booking:
         self.seatIds = seatIds
         self.amount = amount
         self.bookingStatus = bookingStatus
-        self.createdAt = datetime.now()
+        self.createdAt = createdAt or datetime.now()
+
+    def getId(self):
+        return self.id
+
+    def getShowId(self):
+        return self.showId
+
+    def getSeatIds(self):
+        return self.seatIds
+
+    def getStatus(self):
+        return self.bookingStatus
+
+    def updateStatus(self, bookingStatus):
+        self.bookingStatus = bookingStatus
 
 # Booking System
 class BookingSystem:
-    def __init__(self):
+    PAYMENT_TIMEOUT = timedelta(minutes=2)
+
+    def __init__(self, paymentWorkers=32):
         self.shows = {}    # showId -> Show
         self.bookings = {}    # bookingId -> Booking
+        self.showIndex = ShowIndex()
+        self.holdReaper = HoldReaper()
+        self.paymentExecutor = ThreadPoolExecutor(max_workers=paymentWorkers)
         self.lock = Lock()
 
+    def getHoldReaper(self):
+        return self.holdReaper
+
     def addShow(self, show):
         with self.lock:
             self.shows[show.getId()] = show
+            self.showIndex.add(show)
+        self.holdReaper.register(show.getSeatManager())
 
     def removeShow(self, showId):
         with self.lock:
-            del self.shows[showId]
+            show = self.shows.pop(showId)
+            self.showIndex.remove(show)
+        self.holdReaper.unregister(show.getSeatManager())
 
     def searchShows(self, title):
-        res = []
-        for show in self.shows.values():
-            if show.getMovie().getTitle().lower() == title.lower():
-                res.append(show)
-        return res
+        return self.queryShows(title=title)
+
+    def queryShows(self, title=None, titlePrefix=None, city=None, theaterId=None, start=None, end=None):
+        with self.lock:
+            showIds = self.showIndex.query(title, titlePrefix, city, theaterId, start, end)
+            if showIds is None:
+                return list(self.shows.values())
+            return [self.shows[showId] for showId in showIds]
     
     def createBooking(self, user, showId, seatIds, paymentMethod):
+        show = self.shows.get(showId)
+        if not show:
+            return None
+        seatManager = show.getSeatManager()
+        # hold, under the show's own lock only
+        heldAt = seatManager.holdSeats(seatIds)
+        if heldAt is None:
+            return None
+        # payment, with no lock held
+        amount = seatManager.calculatePrice(seatIds)
+        future = self.paymentExecutor.submit(PaymentService().makePayment, paymentMethod, user, amount)
+        try:
+            paymentStatus = future.result(timeout=self.PAYMENT_TIMEOUT.total_seconds())
+        except TimeoutError:
+            # a queued payment is cancelled before it charges; one already running is refunded if it succeeds late
+            seatManager.releaseHold(seatIds, heldAt)
+            if not future.cancel():
+                future.add_done_callback(lambda done: self.refundLatePayment(done, paymentMethod, user, amount))
+            return None
+        if paymentStatus != PaymentStatus.SUCCESS:
+            seatManager.releaseHold(seatIds, heldAt)
+            return None
+        # confirm, re-validating that the hold is still ours
+        if not seatManager.confirmHold(seatIds, heldAt):
+            seatManager.releaseHold(seatIds, heldAt)
+            PaymentService().refundPayment(paymentMethod, user, amount)
+            return None
         with self.lock:
-            show = self.shows[showId]
-            seatManager = show.getSeatManager()
-            if not show:
-                return None
-            # hold
-            if not seatManager.hold(seatIds):
-                return None
-            # pyament
-            amount = seatManager.calculatePrice(seatIds)
-            paymentStatus = PaymentService().makePayment(paymentMethod, user, amount)
-            if paymentStatus != PaymentStatus.SUCCESS:
-                seatManager.cancelSeats(seatIds)
-                return None
-            # confirm
-            seatManager.book(seatIds)
-            booking = Booking(str(len(self.bookings)+1), show, seatIds, user)
-            booking.updateStatus(BookingStatus.CONFIRMED)
+            booking = Booking(str(len(self.bookings)+1), showId, seatIds, amount, BookingStatus.CONFIRMED, None)
             self.bookings[booking.getId()] = booking
-            return booking
\ No newline at end of file
+        return booking
+
+    def refundLatePayment(self, future, paymentMethod, user, amount):
+        if future.exception() is None and future.result() == PaymentStatus.SUCCESS:
+            PaymentService().refundPayment(paymentMethod, user, amount)
+
+# Load Test
+class SimulatedPayment(PaymentGateway):
+    def __init__(self, latency=0.05, failureRate=0.0):
+        self.latency = latency
+        self.failureRate = failureRate
+
+    def pay(self, user, amount):
+        time.sleep(self.latency)
+        if random.random() < self.failureRate:
+            return PaymentStatus.FAILED
+        return PaymentStatus.SUCCESS
+
+    def refund(self, user, amount):
+        return PaymentStatus.SUCCESS
+
+class TimedLock:
+    def __init__(self):
+        self.lock = Lock()
+        self.statsLock = Lock()
+        self.waitTime = 0.0
+        self.acquisitions = 0
+
+    def acquire(self):
+        start = time.perf_counter()
+        self.lock.acquire()
+        waited = time.perf_counter() - start
+        with self.statsLock:
+            self.waitTime += waited
+            self.acquisitions += 1
+        return True
+
+    def release(self):
+        self.lock.release()
+
+    def __enter__(self):
+        return self.acquire()
+
+    def __exit__(self, *args):
+        self.release()
+
+class LoadTest:
+    def __init__(self, shows=4, rows=20, cols=30, paymentLatency=0.05, paymentFailureRate=0.0,
+                 threads=64, opsPerThread=200, hotSeats=40, maxSeatsPerBooking=4, holdTimeout=None, compact=False, seed=None):
+        self.shows = shows
+        self.rows = rows
+        self.cols = cols
+        self.paymentLatency = paymentLatency
+        self.paymentFailureRate = paymentFailureRate
+        self.threads = threads
+        self.opsPerThread = opsPerThread
+        self.hotSeats = hotSeats    # bookings are drawn from the first hotSeats seats of each show
+        self.maxSeatsPerBooking = maxSeatsPerBooking
+        self.holdTimeout = holdTimeout    # timedelta; shortens holds so expiry is exercised
+        self.compact = compact    # run the shows on CompactSeatMap
+        self.seed = seed
+        self.latencies = {}    # op -> list of seconds
+        self.latencyLock = Lock()
+        self.bookingSystem = None
+        self.seatIds = []    # showId -> list of seatIds
+
+    def build(self):
+        self.bookingSystem = BookingSystem(paymentWorkers=self.threads)
+        theater = Theater(1, "Load Test Theater", "Load City")
+        movie = Movie(1, "Blockbuster", 180, "English")
+        startTime = datetime.now()
+        for showId in range(self.shows):
+            seats = {}
+            for row in range(self.rows):
+                for col in range(self.cols):
+                    seatId = f"{row}-{col}"
+                    seatType = SeatType.RECLINER if row >= self.rows - 2 else SeatType.NORMAL
+                    seats[seatId] = Seat(seatId, seatType, SeatStatus.AVAILABLE, row, col)
+            show = Show(showId, movie, theater, seats, startTime, self.compact)
+            seatManager = show.getSeatManager()
+            seatManager.lock = TimedLock()
+            if self.holdTimeout is not None:
+                seatManager.HOLD_TIMEOUT = self.holdTimeout.total_seconds() if self.compact else self.holdTimeout
+            self.bookingSystem.addShow(show)
+            self.seatIds.append(list(seats)[:self.hotSeats])
+        return self.bookingSystem
+
+    def record(self, op, elapsed):
+        with self.latencyLock:
+            self.latencies.setdefault(op, []).append(elapsed)
+
+    def timed(self, op, fn, *args):
+        start = time.perf_counter()
+        res = fn(*args)
+        self.record(op, time.perf_counter() - start)
+        return res
+
+    def step(self, rng, user, paymentMethod):
+        showId = rng.randrange(self.shows)
+        seatManager = self.bookingSystem.shows[showId].getSeatManager()
+        seatIds = rng.sample(self.seatIds[showId], rng.randint(1, self.maxSeatsPerBooking))
+        r = rng.random()
+        if r < 0.6:
+            self.timed("view", seatManager.view)
+        elif r < 0.8:
+            self.timed("hold", seatManager.hold, seatIds)
+        elif r < 0.85:
+            self.timed("releaseExpiredHolds", seatManager.releaseExpiredHolds)
+        else:
+            self.timed("createBooking", self.bookingSystem.createBooking, user, showId, seatIds, paymentMethod)
+
+    def worker(self, workerId):
+        rng = random.Random(None if self.seed is None else self.seed + workerId)
+        user = User(workerId, f"user{workerId}", "")
+        paymentMethod = SimulatedPayment(self.paymentLatency, self.paymentFailureRate)
+        for _ in range(self.opsPerThread):
+            self.step(rng, user, paymentMethod)
+
+    def run(self):
+        self.build()
+        start = time.perf_counter()
+        workers = [Thread(target=self.worker, args=(i,)) for i in range(self.threads)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        return self.report(time.perf_counter() - start)
+
+    async def asyncWorker(self, workerId):
+        rng = random.Random(None if self.seed is None else self.seed + workerId)
+        user = User(workerId, f"user{workerId}", "")
+        paymentMethod = SimulatedPayment(self.paymentLatency, self.paymentFailureRate)
+        for _ in range(self.opsPerThread):
+            await asyncio.to_thread(self.step, rng, user, paymentMethod)
+
+    def runAsync(self):
+        self.build()
+        start = time.perf_counter()
+
+        async def main():
+            await asyncio.gather(*(self.asyncWorker(i) for i in range(self.threads)))
+
+        asyncio.run(main())
+        return self.report(time.perf_counter() - start)
+
+    def percentile(self, values, pct):
+        values = sorted(values)
+        return values[min(len(values) - 1, int(len(values) * pct / 100))]
+
+    def violations(self):
+        # a seat may appear in at most one confirmed booking, and only booked seats may be booked
+        res = []
+        owners = {}    # (showId, seatId) -> bookingId
+        for booking in self.bookingSystem.bookings.values():
+            for seatId in booking.getSeatIds():
+                key = (booking.getShowId(), seatId)
+                if key in owners:
+                    res.append(f"seat {key} booked by {owners[key]} and {booking.getId()}")
+                owners[key] = booking.getId()
+        for showId, show in self.bookingSystem.shows.items():
+            seatManager = show.getSeatManager()
+            statuses = seatManager.viewBySeat() if isinstance(seatManager, CompactSeatMap) else seatManager.view()
+            for seatId, status in statuses.items():
+                if (status == SeatStatus.BOOKED) != ((showId, seatId) in owners):
+                    res.append(f"seat {(showId, seatId)} has status {status} but booking owner {owners.get((showId, seatId))}")
+        return res
+
+    def report(self, elapsed):
+        res = {"elapsed": elapsed, "ops": {}}
+        for op, values in self.latencies.items():
+            res["ops"][op] = {
+                "count": len(values),
+                "p50": self.percentile(values, 50),
+                "p99": self.percentile(values, 99),
+            }
+        bookings = len(self.bookingSystem.bookings)
+        res["bookings"] = bookings
+        res["bookingsPerSecond"] = bookings / elapsed if elapsed else 0.0
+        waitTime = acquisitions = 0
+        for show in self.bookingSystem.shows.values():
+            lock = show.getSeatManager().lock
+            waitTime += lock.waitTime
+            acquisitions += lock.acquisitions
+        res["lockWaitTime"] = waitTime
+        res["lockWaitPerAcquisition"] = waitTime / acquisitions if acquisitions else 0.0
+        res["violations"] = self.violations()
+        self.bookingSystem.paymentExecutor.shutdown()
+        return res
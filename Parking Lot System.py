@@ -1,3 +1,11 @@
+from enum import Enum
+from threading import Lock, Thread, Barrier
+from datetime import datetime
+from itertools import count
+import heapq
+import random
+import time
+
 # Enums
 class VehicleType(Enum):
     BIKE = 1
@@ -16,20 +24,24 @@ class Vehicle:
         self.vehicleType = vehicleType
 
     def getVehicleNum(self):
-        return self.vehicleType
+        return self.vehicleNum
     
     def getVehicleType(self):
         return self.vehicleType
     
 # Parking Spot
 class ParkingSpot:
-    def __init__(self, spotId, spotType, vehicle=None):
+    def __init__(self, spotId, spotType, vehicle=None, spotNum=0):
         self.spotId = spotId
         self.spotType = spotType
         self.vehicle = vehicle
+        self.spotNum = spotNum    # position among spots of the same type on its floor
 
     def getSpotId(self):
         return self.spotId
+
+    def getSpotNum(self):
+        return self.spotNum
     
     def getSpotType(self):
         return self.spotType
@@ -53,19 +65,46 @@ class ParkingSpot:
         return False
     
 # Parking Floor
-class ParkingFloors:
+class ParkingFloor:
     def __init__(self, floorNum, compact, large, handicapped):
         self.floorNum = floorNum
         self.parkingSpots = []    # List of parking spots
-        for i in range(compact):
-            self.parkingSpots.append(f"C{i}_F{self.floorNum}", SpotType.COMPACT)
-        for i in range(large):
-            self.parkingSpots.append(f"L{i}_F{self.floorNum}", SpotType.LARGE)
-        for i in range(handicapped):
-            self.parkingSpots.append(f"H{i}_F{self.floorNum}", SpotType.HANDICAPPED)
+        self.freeSpots = {spotType: [] for spotType in SpotType}    # SpotType -> min-heap of (spot number, spot)
+        for spotType, prefix, total in ((SpotType.COMPACT, "C", compact), (SpotType.LARGE, "L", large), (SpotType.HANDICAPPED, "H", handicapped)):
+            for i in range(total):
+                spot = ParkingSpot(f"{prefix}{i}_F{self.floorNum}", spotType, spotNum=i)
+                self.parkingSpots.append(spot)
+                self.freeSpots[spotType].append((i, spot))
+        # built in spot-number order, so each list is already a valid heap
+        self.lock = Lock()    # guards freeSpots and the vehicles parked on this floor
+
+    def getFloorNum(self):
+        return self.floorNum
     
     def getParkingSpots(self):
         return self.parkingSpots
+
+    def getFreeCount(self, spotType):
+        return len(self.freeSpots[spotType])
+
+    def takeSpot(self, spotType, vehicle):
+        # claims the lowest-numbered free spot of spotType for vehicle, or None
+        pool = self.freeSpots[spotType]
+        if not pool:
+            return None    # unlocked peek, full floors are skipped without contending
+        with self.lock:
+            if not pool:
+                return None
+            spot = heapq.heappop(pool)[1]
+            spot.assignVehicle(vehicle)
+        return spot
+
+    def releaseSpot(self, spot):
+        with self.lock:
+            if not spot.releaseVehicle():
+                return False
+            heapq.heappush(self.freeSpots[spot.getSpotType()], (spot.getSpotNum(), spot))
+        return True
     
 # Parking Lot
 class ParkingLot:
@@ -74,6 +113,16 @@ class ParkingLot:
         self.parkingFloors = []    # list of parking floors
         for i in range(self.totalFloors):
             self.parkingFloors.append(ParkingFloor(i, compact, large, handicapped))
+        self.freeCounts = {spotType: 0 for spotType in SpotType}    # SpotType -> free spots not yet claimed by a gate
+        self.floorsWithFree = {spotType: [] for spotType in SpotType}    # SpotType -> min-heap of floorNums, may hold stale entries
+        self.inHeap = {spotType: set() for spotType in SpotType}    # SpotType -> floorNums currently in floorsWithFree
+        self.poolLocks = {spotType: Lock() for spotType in SpotType}    # guard the three maps above, never held across a floor lock
+        for floor in self.parkingFloors:
+            for spotType in SpotType:
+                if floor.getFreeCount(spotType):
+                    self.freeCounts[spotType] += floor.getFreeCount(spotType)
+                    self.floorsWithFree[spotType].append(floor.getFloorNum())
+                    self.inHeap[spotType].add(floor.getFloorNum())
 
     def getRequiredSpotType(self, vehicleType, isHandicapped):
         if vehicleType == VehicleType.BIKE or vehicleType == VehicleType.CAR:
@@ -87,60 +136,365 @@ class ParkingLot:
 
     def getParkingFloors(self):
         return self.parkingFloors
+
+    def getFreeCount(self, spotType):
+        return self.freeCounts[spotType]
+
+    def isFull(self, spotType):
+        return self.freeCounts[spotType] == 0
+
+    def takeSpot(self, spotType, vehicle, preferredFloor=None):
+        # returns (floor, spot) from preferredFloor if it has a free spotType, else from the lowest floor
+        # that has one, or (None, None) when the lot is full
+        with self.poolLocks[spotType]:
+            if self.freeCounts[spotType] == 0:
+                return None, None
+            self.freeCounts[spotType] -= 1    # reserves one free spot, so the search below cannot come up empty
+        if preferredFloor is not None:
+            floor = self.parkingFloors[preferredFloor]
+            spot = floor.takeSpot(spotType, vehicle)
+            if spot is not None:
+                return floor, spot
+        while True:
+            with self.poolLocks[spotType]:
+                floors = self.floorsWithFree[spotType]
+                while floors and self.parkingFloors[floors[0]].getFreeCount(spotType) == 0:
+                    self.inHeap[spotType].discard(heapq.heappop(floors))    # stale: the floor filled up since it was pushed
+                if not floors:
+                    self.freeCounts[spotType] += 1
+                    return None, None
+                floor = self.parkingFloors[floors[0]]
+            # another gate may claim this floor's last spot first; the heap top then moves on
+            spot = floor.takeSpot(spotType, vehicle)
+            if spot is not None:
+                return floor, spot
+
+    def releaseSpot(self, floor, spot):
+        # the spot is back in its floor pool before the counter says so
+        if not floor.releaseSpot(spot):
+            return False
+        spotType = spot.getSpotType()
+        with self.poolLocks[spotType]:
+            if floor.getFloorNum() not in self.inHeap[spotType]:
+                heapq.heappush(self.floorsWithFree[spotType], floor.getFloorNum())
+                self.inHeap[spotType].add(floor.getFloorNum())
+            self.freeCounts[spotType] += 1
+        return True
         
 # Parking Ticket
 class ParkingTicket:
-    def __init__(self, vehicle, spotId, floor):
+    def __init__(self, vehicle, spotId, floor, ticketId=None):
+        self.ticketId = ticketId
         self.vehicle = vehicle
         self.spotId = spotId
         self.floor = floor
         self.issueTime = datetime.now()
 
+    def getTicketId(self):
+        return self.ticketId
+
+    def getVehicle(self):
+        return self.vehicle
+
     def getSpotId(self):
         return self.spotId
 
     def getFloor(self):
         return self.floor
 
-    def getTicket():
-        return f"Ticket(vehicle={self.vehcile.getVehcileNum()}, spotId={self.spotId.getSpotId()}, floor={self.floor.getFloorNum()}, issueTime={self.issueTime})"
+    def getTicket(self):
+        return f"Ticket(id={self.ticketId}, vehicle={self.vehicle.getVehicleNum()}, spotId={self.spotId}, floor={self.floor}, issueTime={self.issueTime})"
     
+# Spot Registry
+class RegistryShard:
+    def __init__(self):
+        self.tickets = {}    # ticketId -> ticket
+        self.byVehicle = {}    # vehicleNum -> ticket
+        self.ticketIds = count()
+        self.lock = Lock()    # keeps tickets and byVehicle in step
+
+class SpotRegistry:
+    def __init__(self, parkingLot, numShards=16):
+        self.spots = {}    # spotId -> (floor, spot), read-only after construction
+        for floor in parkingLot.getParkingFloors():
+            for spot in floor.getParkingSpots():
+                self.spots[spot.getSpotId()] = (floor, spot)
+        self.shards = [RegistryShard() for _ in range(numShards)]
+
+    def shardIndex(self, vehicleNum):
+        return hash(vehicleNum) % len(self.shards)
+
+    def getSpot(self, spotId):
+        return self.spots.get(spotId, (None, None))
+
+    @staticmethod
+    def isTicketId(ticketId):
+        # ticket ids are non-negative ints
+        return isinstance(ticketId, int) and not isinstance(ticketId, bool) and ticketId >= 0
+
+    def getTicket(self, ticketId):
+        # a ticket lives in the shard its id was drawn from
+        if not self.isTicketId(ticketId):
+            return None
+        return self.shards[ticketId % len(self.shards)].tickets.get(ticketId)
+
+    def findTicket(self, vehicleNum):
+        return self.shards[self.shardIndex(vehicleNum)].byVehicle.get(vehicleNum)
+
+    def getActiveCount(self):
+        return sum(len(shard.tickets) for shard in self.shards)
+
+    def issueTicket(self, vehicle, floor, spot):
+        # None if the vehicle already holds a ticket
+        index = self.shardIndex(vehicle.getVehicleNum())
+        shard = self.shards[index]
+        with shard.lock:
+            if vehicle.getVehicleNum() in shard.byVehicle:
+                return None
+            ticketId = next(shard.ticketIds) * len(self.shards) + index
+            ticket = ParkingTicket(vehicle, spot.getSpotId(), floor.getFloorNum(), ticketId)
+            shard.tickets[ticketId] = ticket
+            shard.byVehicle[vehicle.getVehicleNum()] = ticket
+        return ticket
+
+    def closeTicket(self, ticket):
+        # only one caller gets True for a given ticket
+        if not self.isTicketId(ticket.getTicketId()):
+            return False
+        shard = self.shards[ticket.getTicketId() % len(self.shards)]
+        with shard.lock:
+            if shard.tickets.get(ticket.getTicketId()) is not ticket:
+                return False
+            del shard.tickets[ticket.getTicketId()]
+            del shard.byVehicle[ticket.getVehicle().getVehicleNum()]
+        return True
+
 # Parking System
 class ParkingSystem:
     _instance = None
     _lock = Lock()
 
     @staticmethod
-    def getInstance(self, parkingLot):
+    def getInstance(parkingLot):
         if not ParkingSystem._instance:
             with ParkingSystem._lock:
-                ParkingSystem._instance = ParkingSystem(parkingLot)
+                if not ParkingSystem._instance:
+                    ParkingSystem._instance = ParkingSystem(parkingLot)
         return ParkingSystem._instance
 
     def __init__(self, parkingLot):
         self.parkingLot = parkingLot
-        self.activeTickets = {}    # vehicleNum -> ticket
+        self.registry = SpotRegistry(parkingLot)
 
-    def park(self, vehicle, isHandicapped):
+    def park(self, vehicle, isHandicapped, gateId=None):
+        # a gate prefers the floor matching its id, so gates rarely share a floor lock; without a gate
+        # the lowest free floor is used
         requiredSpotType = self.parkingLot.getRequiredSpotType(vehicle.getVehicleType(), isHandicapped)
-        for floor in self.parkingLot.getParkingsFloors():
-            for spot in floor.getParkingSpots():
-                if spot.getSpotType() == requiredSpotType:
-                    res = spot.assignVehicle(vehicle)
-                    if not res:
-                        continue
-                    ticket = ParkingTicket(vehicle, spot.getSpotId(), floor.getFloorNum())
-                    self.activeTickets[vehicle.getVehicleNum()] = ticket
-                    return ticket
-        return None
+        if self.registry.findTicket(vehicle.getVehicleNum()):
+            return None
+        preferredFloor = None if gateId is None else gateId % self.parkingLot.totalFloors
+        floor, spot = self.parkingLot.takeSpot(requiredSpotType, vehicle, preferredFloor)
+        if spot is None:
+            return None
+        ticket = self.registry.issueTicket(vehicle, floor, spot)
+        if ticket is None:
+            self.parkingLot.releaseSpot(floor, spot)    # lost a race with another gate for the same vehicle
+        return ticket
     
     def unpark(self, ticket):
-        floor = ticket.getFloor()
-        spotId = ticket.getSpotId()
-        for spot in floor.getParkingSpots():
-            if spot.getSpotId() == spotId:
-                res = spot.releaseVehicle()
-                if res:
-                    del self.activeTickets[ticket.getVehcileNum()]
-                    return True
-        return False
\ No newline at end of file
+        if not self.registry.closeTicket(ticket):
+            return False
+        floor, spot = self.registry.getSpot(ticket.getSpotId())
+        self.parkingLot.releaseSpot(floor, spot)
+        return True
+
+    def unparkById(self, ticketId):
+        ticket = self.registry.getTicket(ticketId)
+        return ticket is not None and self.unpark(ticket)
+
+    def getTicket(self, ticketId):
+        return self.registry.getTicket(ticketId)
+
+    def locateVehicle(self, vehicleNum):
+        # (floorNum, spotId) of a parked vehicle, or None
+        ticket = self.registry.findTicket(vehicleNum)
+        if ticket is None:
+            return None
+        return ticket.getFloor(), ticket.getSpotId()
+
+# Benchmark
+class ExitBenchmark:
+    def __init__(self, floors=10, spotsPerFloor=(100, 1000, 10000), exits=1000, seed=None):
+        self.floors = floors
+        self.spotsPerFloor = spotsPerFloor    # one run per lot size
+        self.exits = exits
+        self.seed = seed
+
+    def build(self, spots):
+        parkingLot = ParkingLot(self.floors, spots, 0, 0)
+        parkingSystem = ParkingSystem(parkingLot)    # bypass the singleton, one system per run
+        tickets = []
+        for i in range(self.floors * spots):
+            tickets.append(parkingSystem.park(Vehicle(f"V{i}", VehicleType.CAR), False))
+        return parkingSystem, tickets
+
+    def runOnce(self, spots):
+        parkingSystem, tickets = self.build(spots)
+        rng = random.Random(self.seed)
+        leaving = rng.sample(tickets, min(self.exits, len(tickets)))
+        start = time.perf_counter()
+        for ticket in leaving:
+            parkingSystem.locateVehicle(ticket.getVehicle().getVehicleNum())
+        located = time.perf_counter()
+        for ticket in leaving:
+            parkingSystem.unpark(ticket)
+        exited = time.perf_counter()
+        return {
+            "spots": len(tickets),
+            "exits": len(leaving),
+            "locatesPerSecond": len(leaving) / (located - start),
+            "exitsPerSecond": len(leaving) / (exited - located),
+            "freeAfter": parkingSystem.parkingLot.getFreeCount(SpotType.COMPACT),
+        }
+
+    def run(self):
+        return [self.runOnce(spots) for spots in self.spotsPerFloor]
+
+class TimedLock:
+    def __init__(self):
+        self.lock = Lock()
+        self.statsLock = Lock()
+        self.waitTime = 0.0
+        self.acquisitions = 0
+
+    def acquire(self, blocking=True, timeout=-1):
+        start = time.perf_counter()
+        acquired = self.lock.acquire(blocking, timeout)
+        waited = time.perf_counter() - start
+        with self.statsLock:
+            self.waitTime += waited
+            self.acquisitions += 1
+        return acquired
+
+    def release(self):
+        self.lock.release()
+
+    def __enter__(self):
+        return self.acquire()
+
+    def __exit__(self, *args):
+        self.release()
+
+class GateStressTest:
+    def __init__(self, gates=(1, 4, 16, 64), floors=8, spotsPerFloor=50, opsPerGate=500,
+                 vehiclesPerGate=20, gateLatency=0.001, seed=None):
+        self.gates = gates    # one run per gate count
+        self.floors = floors
+        self.spotsPerFloor = spotsPerFloor    # small lot so gates keep competing for the last spots
+        self.opsPerGate = opsPerGate
+        self.vehiclesPerGate = vehiclesPerGate
+        self.gateLatency = gateLatency    # barrier arm / plate reader time, spent outside any lock
+        self.seed = seed
+
+    def build(self):
+        self.parkingLot = ParkingLot(self.floors, self.spotsPerFloor, 0, 0)
+        for floor in self.parkingLot.getParkingFloors():
+            floor.lock = TimedLock()
+        for spotType in SpotType:
+            self.parkingLot.poolLocks[spotType] = TimedLock()
+        self.parkingSystem = ParkingSystem(self.parkingLot)    # bypass the singleton, one system per run
+        self.claims = {}    # spotId -> vehicleNum of the live ticket holding it
+        self.violations = []
+        self.ops = 0
+        self.statsLock = Lock()
+
+    def claim(self, ticket):
+        # dict.setdefault is atomic, so a second live claim on a spot is always seen
+        vehicleNum = ticket.getVehicle().getVehicleNum()
+        owner = self.claims.setdefault(ticket.getSpotId(), vehicleNum)
+        if owner != vehicleNum:
+            self.violations.append(f"{ticket.getSpotId()} given to {vehicleNum} while held by {owner}")
+
+    def unclaim(self, ticket):
+        # drop the claim before the spot is released, while nobody else can be handed it
+        vehicleNum = ticket.getVehicle().getVehicleNum()
+        owner = self.claims.pop(ticket.getSpotId(), None)
+        if owner != vehicleNum:
+            self.violations.append(f"{ticket.getSpotId()} claimed by {owner} when {vehicleNum} left")
+        floor, spot = self.parkingSystem.registry.getSpot(ticket.getSpotId())
+        if spot.getVehicle() is not ticket.getVehicle():
+            self.violations.append(f"{ticket.getSpotId()} holds someone else when {vehicleNum} left")
+
+    def worker(self, gateId, barrier):
+        rng = random.Random(None if self.seed is None else self.seed + gateId)
+        vehicles = [Vehicle(f"G{gateId}_V{i}", VehicleType.CAR) for i in range(self.vehiclesPerGate)]
+        tickets = {}    # vehicleNum -> ticket
+        ops = 0
+        barrier.wait()
+        for _ in range(self.opsPerGate):
+            vehicle = rng.choice(vehicles)
+            time.sleep(self.gateLatency)
+            ticket = tickets.pop(vehicle.getVehicleNum(), None)
+            if ticket is None:
+                ticket = self.parkingSystem.park(vehicle, False, gateId)
+                if ticket is not None:
+                    self.claim(ticket)
+                    tickets[vehicle.getVehicleNum()] = ticket
+            else:
+                self.unclaim(ticket)
+                if not self.parkingSystem.unpark(ticket):
+                    self.violations.append(f"ticket {ticket.getTicketId()} could not be closed")
+            ops += 1
+        with self.statsLock:
+            self.ops += ops
+
+    def checkLot(self):
+        # end state: every occupied spot matches exactly one live ticket and is absent from the free pools
+        res = []
+        registry = self.parkingSystem.registry
+        occupied = 0
+        for floor in self.parkingLot.getParkingFloors():
+            free = set(spot.getSpotId() for spotNum, spot in floor.freeSpots[SpotType.COMPACT])
+            for spot in floor.getParkingSpots():
+                if spot.isAvailable():
+                    if spot.getSpotId() not in free:
+                        res.append(f"{spot.getSpotId()} is empty but not in a free pool")
+                    continue
+                occupied += 1
+                if spot.getSpotId() in free:
+                    res.append(f"{spot.getSpotId()} is occupied and in a free pool")
+                ticket = registry.findTicket(spot.getVehicle().getVehicleNum())
+                if ticket is None or ticket.getSpotId() != spot.getSpotId():
+                    res.append(f"{spot.getSpotId()} holds {spot.getVehicle().getVehicleNum()} without a matching ticket")
+        if occupied != registry.getActiveCount():
+            res.append(f"{occupied} occupied spots but {registry.getActiveCount()} active tickets")
+        if occupied + self.parkingLot.getFreeCount(SpotType.COMPACT) != self.floors * self.spotsPerFloor:
+            res.append("occupied and free spots do not add up to capacity")
+        return res
+
+    def waitPerAcquisition(self, locks):
+        waitTime = sum(lock.waitTime for lock in locks)
+        acquisitions = sum(lock.acquisitions for lock in locks)
+        return waitTime / acquisitions if acquisitions else 0.0
+
+    def runOnce(self, gates):
+        self.build()
+        barrier = Barrier(gates)
+        workers = [Thread(target=self.worker, args=(i, barrier)) for i in range(gates)]
+        start = time.perf_counter()
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        elapsed = time.perf_counter() - start
+        return {
+            "gates": gates,
+            "elapsed": elapsed,
+            "opsPerSecond": self.ops / elapsed,
+            "floorLockWaitPerAcquisition": self.waitPerAcquisition([floor.lock for floor in self.parkingLot.getParkingFloors()]),
+            "poolLockWaitPerAcquisition": self.waitPerAcquisition(list(self.parkingLot.poolLocks.values())),
+            "violations": self.violations + self.checkLot(),
+        }
+
+    def run(self):
+        return [self.runOnce(gates) for gates in self.gates]